@@ -0,0 +1,254 @@
+import os
+import re
+import json
+import atexit
+import base64
+import hashlib
+import urllib
+import urlparse
+import threading
+
+from app import mock
+
+settings = {
+    'record': None,
+    'replay': None,
+}
+
+# the interactions recorded or replayed in this process, key -> Interaction
+_interactions = {}
+_lock = threading.Lock()
+# the scenario the requests of each thread belong to
+_scope = threading.local()
+
+re_boundary = re.compile(r'boundary="?([^";]+)"?')
+# the ids of the requests of a batch are prefixed by a random uuid
+re_content_id = re.compile(r'(Content-ID: <)[^ >]+ \+ ')
+re_authorization = re.compile(r'^authorization: .*\n', re.IGNORECASE | re.MULTILINE)
+
+
+def configure(record=None, replay=None):
+    """
+    Record the requests and their responses in the `record` folder, or replay them from the `replay` folder
+    """
+    if record and replay:
+        raise ValueError("The requests cannot be both recorded and replayed")
+    settings['record'] = record
+    settings['replay'] = replay
+
+
+def scenario_scope(scenario_file):
+    """
+    The scope of the requests of a scenario file, its path relative to the current folder
+    """
+    return os.path.relpath(scenario_file).replace(os.sep, '/')
+
+
+def set_scope(scope):
+    """
+    Tell the requests sent by the calling thread belong to a scenario
+    """
+    _scope.scenario = scope
+
+
+def get_scope():
+    return getattr(_scope, 'scenario', None)
+
+
+def normalize_uri(uri):
+    """
+    The uri with its query parameters sorted
+    """
+    scheme, netloc, path, query, fragment = urlparse.urlsplit(uri)
+    query = urllib.urlencode(sorted(urlparse.parse_qsl(query, keep_blank_values=True)))
+    return urlparse.urlunsplit((scheme, netloc, path, query, fragment))
+
+
+def normalize_body(body, headers=None):
+    """
+    The body with the parts changing from a run to another replaced
+
+    The json bodies are written with sorted keys, the boundary, the request
+    ids and the authorization headers of the batch requests are removed.
+    """
+    if not body:
+        return ''
+    try:
+        return json.dumps(json.loads(body), sort_keys=True)
+    except ValueError:
+        pass
+
+    match = re_boundary.search((headers or {}).get('content-type', ''))
+    if match:
+        body = body.replace(match.group(1), 'BOUNDARY')
+    body = re_content_id.sub(r'\1batch + ', body)
+    return re_authorization.sub('', body)
+
+
+def request_key(scenario, method, uri, body=None, headers=None):
+    """
+    The key of a request, its scenario file is part of it so that each scenario replays its own responses
+    """
+    key = json.dumps([scenario, method.upper(), normalize_uri(uri), normalize_body(body, headers)])
+    return hashlib.sha1(key).hexdigest()
+
+
+class Interaction(object):
+    """
+    The responses received for the same request, in the order they were received
+
+    They are replayed in the same order, the last one being used again once
+    they are all replayed. The recorded responses are kept in memory until
+    they are saved.
+    """
+    def __init__(self, path, description=None, responses=None):
+        self.path = path
+        self.description = description or {}
+        self.responses = responses or []
+        self.replayed = 0
+        # the responses were recorded since the file was written
+        self.changed = False
+        self.lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r') as f:
+            data = json.load(f)
+        return cls(path, data['request'], data['responses'])
+
+    def record(self, resp, content):
+        if isinstance(content, unicode):
+            content = content.encode('utf-8')
+        try:
+            response = {'headers': dict(resp), 'content': content.decode('utf-8')}
+        except UnicodeDecodeError:
+            response = {'headers': dict(resp), 'content': base64.b64encode(content), 'base64': True}
+        response['headers']['status'] = str(resp.status)
+
+        with self.lock:
+            self.responses.append(response)
+            self.changed = True
+
+    def save(self):
+        """
+        Write the responses to the file if some were recorded since it was written
+        """
+        with self.lock:
+            if not self.changed:
+                return
+            data = {'request': self.description, 'responses': self.responses}
+
+            folder = os.path.dirname(self.path)
+            if not os.path.isdir(folder):
+                os.makedirs(folder)
+            # write then rename, so that an interrupted run does not leave a broken file
+            tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+            with open(tmp_path, 'w') as f:
+                json.dump(data, f, indent=2, separators=(',', ': '), sort_keys=True)
+            os.rename(tmp_path, self.path)
+            self.changed = False
+
+    def replay(self):
+        from httplib2 import Response
+
+        with self.lock:
+            response = self.responses[min(self.replayed, len(self.responses) - 1)]
+            self.replayed += 1
+
+        content = response['content']
+        content = base64.b64decode(content) if response.get('base64') else content.encode('utf-8')
+        return Response(response['headers']), content
+
+
+def _get_interaction(folder, key, description=None, fresh=False):
+    """
+    Return the interaction of a request key, `fresh` ignores the responses recorded by a previous run
+    """
+    with _lock:
+        if key not in _interactions:
+            path = os.path.join(folder, key + '.json')
+            if fresh:
+                _interactions[key] = Interaction(path, description)
+            elif os.path.isfile(path):
+                _interactions[key] = Interaction.load(path)
+            else:
+                return None
+        return _interactions[key]
+
+
+@atexit.register
+def save():
+    """
+    Write the responses recorded since they were last saved, at the end of each scenario and of the process
+    """
+    with _lock:
+        interactions = _interactions.values()
+    for interaction in interactions:
+        interaction.save()
+
+
+class RecordingHttp(object):
+    """
+    Send the requests through an http object and record their responses in a folder
+
+    With `scoped`, the responses are recorded for the running scenario.
+    """
+    def __init__(self, http, folder, scoped=True):
+        self.http = http
+        self.folder = folder
+        self.scoped = scoped
+        # the credentials of an authorized http object, read by the api client for the batch requests
+        credentials = getattr(http.request, 'credentials', None)
+        if credentials is not None:
+            self.credentials = credentials
+
+    def request(self, uri, method='GET', body=None, headers=None, *args, **kwargs):
+        resp, content = self.http.request(uri, method, body, headers, *args, **kwargs)
+
+        scenario = get_scope() if self.scoped else None
+        key = request_key(scenario, method, uri, body, headers)
+        description = {'scenario': scenario, 'method': method.upper(), 'uri': uri}
+        _get_interaction(self.folder, key, description, fresh=True).record(resp, content)
+        return resp, content
+
+
+class ReplayHttp(object):
+    """
+    An httplib2.Http stand-in answering the requests with the responses recorded in a folder
+
+    With `scoped`, the responses recorded for the running scenario are used.
+    """
+    def __init__(self, folder, scoped=True):
+        self.folder = folder
+        self.scoped = scoped
+
+    def request(self, uri, method='GET', body=None, headers=None, *args, **kwargs):
+        scenario = get_scope() if self.scoped else None
+        interaction = _get_interaction(self.folder, request_key(scenario, method, uri, body, headers))
+        if interaction is None:
+            raise RuntimeError("No response recorded in {} for {} {}".format(self.folder, method.upper(), uri))
+        return interaction.replay()
+
+
+def new_http(authorize=None, scoped=True, document=None):
+    """
+    Return the http object sending the requests
+
+    `authorize` is called with an httplib2.Http object and returns it with
+    the credentials, it is not called when the responses are replayed or
+    when the requests of the API of the discovery `document` are answered
+    by the mock backend.
+    """
+    if settings['replay']:
+        return ReplayHttp(settings['replay'], scoped)
+
+    if document is not None and mock.settings['config']:
+        http = mock.MockHttp(mock.get_backend(document))
+    else:
+        from httplib2 import Http
+        http = Http()
+        if authorize:
+            http = authorize(http)
+    if settings['record']:
+        return RecordingHttp(http, settings['record'], scoped)
+    return http
@@ -0,0 +1,532 @@
+import os
+import json
+import traceback
+
+from multiprocessing import Pool
+
+from app import concurrency
+from app import discovery
+from app import files
+from app.default import BATCH_OPTIONS, DEFAULT_BATCH_SIZE, MAX_BATCH_SIZE, parse_save_result
+from app.latency import LatencyCheck
+from app.pagination import Paginator
+from app.results import Exporter
+from app.retry import RetryPolicy
+from app.template import expression_matcher, load_template
+from jsonpath import check_path
+import utils as ju
+
+# the keys of a command which are not its endpoint
+COMMAND_OPTIONS = ('check_result', 'save_result', 'check_code', 'check_message', 'print_result', 'print_body',
+                   'export_result', 'eval_expr', 'pre_eval_expr', 'repeat', 'description', 'check_order', 'hooks',
+                   'paginate', 'retry', 'check_latency', 'config', 'post_delay', 'depends_on')
+# the keys of a command holding a batch of commands
+BATCH_COMMAND_OPTIONS = ('batch', 'config', 'post_delay', 'depends_on')
+REPEAT_MODES = ('while', 'until', 'loop')
+
+# (api, version, discovery_url) -> parsed document, None if not cached
+_documents = {}
+
+
+def _get_document(service_config):
+    key = (service_config['api'], service_config['version'], service_config.get('discovery_url'))
+    if key not in _documents:
+        document = discovery.get_cached_document(*key)
+        _documents[key] = json.loads(document) if document else None
+    return _documents[key]
+
+
+def _as_list(value):
+    return value if isinstance(value, list) else [value]
+
+
+class ScenarioChecker(object):
+    """
+    Check a scenario and its includes without running it
+
+    The commands are checked against the cached discovery document of their
+    service if any: the endpoint keys must be methods of the API and the
+    arguments must be parameters of the method. The expressions must be valid
+    jsonpath expressions, the code must compile and the saved results must be
+    saved by a command run before the ones reading them.
+    """
+    def __init__(self, scene, scene_root):
+        self.scene = scene
+        self.scene_root = scene_root
+        self.errors = []
+        self.notes = []
+        # the discovery documents which are not cached
+        self.missing_documents = set()
+
+    def error(self, where, message):
+        self.errors.append(u"{}: {}".format(where, message) if where else unicode(message))
+
+    def find_file(self, where, path):
+        """
+        Return the path of a file referenced by the scenario, None if it cannot be found
+        """
+        found = files.find_file(self.scene_root, path, strict=False)
+        if not found:
+            self.error(where, u"{} cannot be found".format(path))
+        return found
+
+    def read_file(self, path):
+        path = files.find_file(self.scene_root, path, strict=False)
+        return files.read_file(path) if path else None
+
+    def check(self):
+        """
+        Check the scenario, returns the list of errors found
+        """
+        scene = self.scene
+        if not isinstance(scene, dict):
+            self.error(None, "A scenario must be a dict")
+            return self.errors
+        if scene.get('skip', False):
+            self.notes.append("skipped")
+            return self.errors
+
+        self.check_settings()
+
+        commands = []
+        for kind in ('setup', 'commands', 'teardown'):
+            for origin, command in self.commands(kind):
+                commands.append((origin, command))
+
+        for import_file in self.includes('import'):
+            where = u"import {}".format(os.path.basename(import_file))
+            try:
+                checker = ScenarioChecker(files.load_include(import_file), self.scene_root)
+            except Exception as e:
+                self.error(where, u"Unable to load {}: {}".format(import_file, e))
+                continue
+            for error in checker.check():
+                self.error(where, error)
+            self.missing_documents |= checker.missing_documents
+
+        if commands and not isinstance(scene.get('service'), dict):
+            self.error(None, "The scenario has commands but no service")
+
+        # the saved results are checked in the order the commands are run
+        saved = set()
+        ordered = True
+        for position, (origin, command) in enumerate(commands):
+            where = u"#{} {}".format(position, self.command_label(command))
+            if origin:
+                where = u"{} (in {})".format(where, os.path.basename(origin))
+            try:
+                self.check_command(where, command)
+            except Exception as e:
+                self.error(where, u"Unable to check the command: {}".format(e))
+
+            if not ordered or not isinstance(command, (dict, basestring)):
+                continue
+            try:
+                deps = concurrency.command_dependencies(command, self.read_file)
+            except Exception:
+                # the command is broken, its error is already reported
+                continue
+            missing = deps.reads - deps.writes - saved - set(concurrency.RESERVED_NAMES)
+            for name in sorted(missing):
+                self.error(where, u"{} is read before any command saves it".format(name))
+            saved |= deps.writes
+            # the command may save any result, the following ones cannot be checked
+            ordered = not deps.writes_all
+
+        if self.missing_documents:
+            self.notes.append("no cached discovery document for {}, the endpoints are not checked".format(
+                ", ".join(sorted(" ".join(key) for key in self.missing_documents))))
+        return self.errors
+
+    def command_label(self, command):
+        if isinstance(command, basestring):
+            return command
+        if isinstance(command, dict):
+            keys = [key for key in command if key not in COMMAND_OPTIONS]
+            return keys[0] if len(keys) == 1 else 'command'
+        return 'command'
+
+    def includes(self, kind):
+        """
+        The paths of the setup, import or teardown files of the scenario
+        """
+        if kind not in self.scene:
+            return []
+        names = self.scene[kind]
+        if isinstance(names, basestring):
+            names = [names]
+        if not isinstance(names, list):
+            self.error(None, "{} must be either a list of filenames or a single filename".format(kind))
+            return []
+
+        found = [self.find_file(kind, name) for name in names]
+        return [path for path in found if path]
+
+    def commands(self, kind):
+        """
+        The commands of the scenario, or of its setup or teardown files, with the file they come from
+        """
+        if kind == 'commands':
+            commands = self.scene.get('commands') or []
+            if not isinstance(commands, list):
+                self.error(None, "commands must be a list")
+                return []
+            return [(None, command) for command in commands]
+
+        found = []
+        for path in self.includes(kind):
+            try:
+                include = files.load_include(path, relative_bodies=kind == 'setup')
+            except Exception as e:
+                self.error(kind, u"Unable to load {}: {}".format(path, e))
+                continue
+            found.extend((path, command) for command in (include or {}).get('commands') or [])
+        return found
+
+    def check_settings(self):
+        """
+        Check the options of the scenario
+        """
+        scene = self.scene
+        if 'concurrency' in scene:
+            workers = scene['concurrency']
+            if isinstance(workers, dict):
+                workers = workers.get('workers', 0)
+            if not isinstance(workers, int) or workers < 0:
+                self.error('concurrency', "Concurrency must be a positive number of workers")
+
+        if 'results' in scene and not isinstance(scene['results'], dict):
+            self.error('results', "results must be a dict")
+
+        if 'check_latency' in scene:
+            config = scene['check_latency']
+            if not isinstance(config, dict):
+                self.error('check_latency', "The scenario check_latency must be a dict")
+            else:
+                config = dict((key, val) for key, val in config.iteritems()
+                              if key not in ('total_ms', 'threshold', 'baseline'))
+                self.check_config('check_latency', LatencyCheck, config)
+
+        if 'retry' in scene:
+            self.check_config('retry', RetryPolicy, scene['retry'])
+
+        if 'print_limit' in scene:
+            limit = scene['print_limit']
+            if not isinstance(limit, int) or limit <= 0:
+                self.error('print_limit', "print_limit must be a positive number of characters")
+
+        if 'hooks' in scene and not isinstance(scene['hooks'], dict):
+            self.error('hooks', "Hooks must be a dict")
+
+    def check_config(self, where, build, config):
+        try:
+            return build(config)
+        except ValueError as e:
+            self.error(where, e)
+
+    def check_expression(self, where, expression):
+        """
+        Check a `{{expression}}` string, other strings are left as is
+        """
+        match = expression_matcher.match(expression)
+        if match:
+            self.check_path(where, match.group(1))
+
+    def check_path(self, where, path):
+        path = path.strip()
+        if path.endswith("as list"):
+            path = path.replace("as list", "").strip()
+        try:
+            check_path(path)
+        except ValueError as e:
+            self.error(where, e)
+
+    def check_value(self, where, value):
+        """
+        Check the expressions of a json value
+        """
+        if isinstance(value, dict):
+            for val in value.itervalues():
+                self.check_value(where, val)
+        elif isinstance(value, list):
+            for val in value:
+                self.check_value(where, val)
+        elif isinstance(value, basestring):
+            self.check_expression(where, value)
+
+    def check_template(self, where, value):
+        """
+        Check a json value or a json file holding expressions
+        """
+        if isinstance(value, dict):
+            self.check_value(where, value)
+        elif isinstance(value, basestring):
+            if expression_matcher.match(value):
+                self.check_expression(where, value)
+                return
+            path = self.find_file(where, value)
+            if path:
+                try:
+                    self.check_value(where, load_template(path).value)
+                except ValueError as e:
+                    self.error(where, u"{} is not a valid json file: {}".format(value, e))
+
+    def check_code(self, where, code, mode='exec'):
+        for c in _as_list(code):
+            if not isinstance(c, basestring):
+                self.error(where, "The code must be a string or a list of strings")
+                continue
+            try:
+                compile(c, where.encode('utf-8'), mode)
+            except SyntaxError as e:
+                self.error(where, u"Invalid python code {}: {}".format(c, e.msg))
+
+    def check_arguments(self, where, key, args, service_config):
+        """
+        Check an endpoint and its arguments against the discovery document of the service
+        """
+        if not isinstance(args, (dict, list)) and args is not None:
+            self.error(where, "The arguments of {} must be a dict".format(key))
+            return
+        args = args if isinstance(args, dict) else {}
+
+        for arg, val in args.iteritems():
+            if arg == 'body' and isinstance(val, basestring):
+                self.check_template(where, val)
+            else:
+                self.check_value(where, val)
+
+        if not isinstance(service_config, dict) or 'api' not in service_config or 'version' not in service_config:
+            return
+        document = _get_document(service_config)
+        if document is None:
+            self.missing_documents.add((service_config['api'], service_config['version']))
+            return
+
+        method = discovery.find_method(document, key)
+        if method is None:
+            self.error(where, u"{} is not a method of {} {}".format(key, service_config['api'],
+                                                                    service_config['version']))
+            return
+
+        accepted, required = discovery.method_arguments(document, method)
+        for arg in sorted(set(args) - accepted):
+            self.error(where, u"{} is not an argument of {}".format(arg, key))
+        for arg in sorted(required - set(args)):
+            self.error(where, u"The required argument {} of {} is missing".format(arg, key))
+
+    def service_config(self, command):
+        """
+        The service of a command, None if it is changed by expressions
+        """
+        service_config = self.scene.get('service')
+        config = command.get('config')
+        if isinstance(config, dict) and isinstance(config.get('service'), dict):
+            if not isinstance(service_config, dict):
+                return None
+            service_config = dict(service_config)
+            for key, val in config['service'].iteritems():
+                if isinstance(val, basestring) and expression_matcher.match(val):
+                    return None
+                service_config[key] = val
+        return service_config
+
+    def check_command(self, where, command):
+        if isinstance(command, basestring):
+            command = {command: {}}
+        if not isinstance(command, dict):
+            self.error(where, "A command must be a dict or an endpoint key")
+            return
+
+        if 'batch' in command:
+            others = [key for key in command if key not in BATCH_COMMAND_OPTIONS]
+            if others:
+                self.error(where, u"A batch command cannot have other keys than {}: {}".format(
+                    ", ".join(BATCH_COMMAND_OPTIONS), ", ".join(sorted(others))))
+            self.check_batch(where, command['batch'], self.service_config(command))
+            return
+
+        endpoints = [key for key in command if key not in COMMAND_OPTIONS]
+        if len(endpoints) != 1:
+            self.error(where, u"You must provide one and only one endpoint per command, found {}".format(
+                ", ".join(sorted(endpoints)) or "none"))
+        else:
+            self.check_arguments(where, endpoints[0], command[endpoints[0]], self.service_config(command))
+
+        self.check_options(where, command)
+
+    def check_batch(self, where, batch, service_config):
+        if isinstance(batch, list):
+            batch = {'commands': batch}
+        if not isinstance(batch, dict) or not isinstance(batch.get('commands'), list):
+            self.error(where, "A batch must be either a list of commands or a dict with a `commands` list")
+            return
+
+        size = batch.get('size', DEFAULT_BATCH_SIZE)
+        if not isinstance(size, int) or size < 1 or size > MAX_BATCH_SIZE:
+            self.error(where, "The batch size must be between 1 and {}".format(MAX_BATCH_SIZE))
+
+        for idx, command in enumerate(batch['commands']):
+            command_where = u"{} [{}]".format(where, idx)
+            if isinstance(command, basestring):
+                command = {command: {}}
+            if not isinstance(command, dict):
+                self.error(command_where, "A command must be a dict or an endpoint key")
+                continue
+
+            endpoints = [key for key in command if key not in BATCH_OPTIONS]
+            if len(endpoints) != 1:
+                self.error(command_where, u"A command of a batch must have one endpoint and only the {} options, "
+                                          u"found {}".format(", ".join(BATCH_OPTIONS), ", ".join(sorted(endpoints))))
+            else:
+                self.check_arguments(command_where, endpoints[0], command[endpoints[0]], service_config)
+            self.check_options(command_where, command)
+
+    def check_options(self, where, command):
+        """
+        Check the options of a command, as they would be read when it is run
+        """
+        if 'save_result' in command:
+            try:
+                _, keep = parse_save_result(command['save_result'])
+                for expression in keep or []:
+                    self.check_expression(where, expression if expression_matcher.match(expression)
+                                          else '{{' + expression + '}}')
+            except ValueError as e:
+                self.error(where, e)
+
+        if 'check_result' in command:
+            self.check_template(where, command['check_result'])
+
+        if 'check_code' in command:
+            try:
+                int(command['check_code'])
+            except (TypeError, ValueError):
+                self.error(where, u"check_code must be a status code, not {}".format(command['check_code']))
+
+        if 'print_result' in command and command['print_result'] is not True:
+            for expression in _as_list(command['print_result']):
+                if isinstance(expression, basestring):
+                    self.check_expression(where, expression)
+
+        if 'export_result' in command:
+            exporter = self.check_config(where, Exporter, command['export_result'])
+            if exporter and exporter.items:
+                self.check_path(where, exporter.items)
+
+        for key in ('eval_expr', 'pre_eval_expr'):
+            if key in command:
+                self.check_code(where, command[key])
+
+        if 'repeat' in command:
+            self.check_repeat(where, command['repeat'])
+
+        if 'check_order' in command:
+            order = command['check_order']
+            if not isinstance(order, list):
+                self.error(where, "check_order must be a list of expressions and directions")
+            else:
+                for criteria in order:
+                    if not isinstance(criteria, dict):
+                        self.error(where, "check_order must be a list of expressions and directions")
+                        continue
+                    for expression, direction in criteria.iteritems():
+                        self.check_expression(where, expression)
+                        if direction not in ('asc', 'desc'):
+                            self.error(where, u'The sort direction "{}" is incorrect. Must be "asc" or "desc"'.format(
+                                direction))
+
+        if 'hooks' in command and not isinstance(command['hooks'], dict):
+            self.error(where, "Hooks must be a dict")
+
+        if 'paginate' in command:
+            paginator = self.check_config(where, Paginator, command['paginate'])
+            if paginator and paginator.mode == 'stream' and 'export_result' in command:
+                exporter = self.check_config(where, Exporter, command['export_result'])
+                try:
+                    if exporter:
+                        exporter.stream()
+                except ValueError as e:
+                    self.error(where, e)
+
+        if 'retry' in command:
+            try:
+                RetryPolicy().override(command['retry'])
+            except ValueError as e:
+                self.error(where, e)
+
+        if 'check_latency' in command:
+            self.check_config(where, LatencyCheck, command['check_latency'])
+
+        if 'config' in command and not isinstance(command['config'], dict):
+            self.error(where, "config must be a dict")
+
+    def check_repeat(self, where, repeat):
+        if not isinstance(repeat, dict):
+            self.error(where, "repeat must be a dict")
+            return
+
+        mode = repeat.get('mode', 'while')
+        if mode not in REPEAT_MODES:
+            self.error(where, u"The repeat mode must be one of {}, not {}".format(", ".join(REPEAT_MODES), mode))
+        if mode == 'loop' and repeat.get('max', 5) == 0:
+            self.error(where, "Maximum cannot be set to zero when using loop mode")
+
+        conditions = repeat.get('conditions', {})
+        if not isinstance(conditions, dict):
+            self.error(where, "The repeat conditions must be a dict")
+        elif conditions.get('expression') is not None:
+            self.check_code(where, conditions['expression'], mode='eval')
+
+
+def check_scenario(scenario_file):
+    """
+    Check a scenario file, returns its errors and notes
+    """
+    try:
+        scene = files.load_scenario(scenario_file)
+        scenario_root = os.path.abspath(os.path.join(os.path.abspath(scenario_file), os.pardir))
+        checker = ScenarioChecker(scene or {}, scenario_root)
+        return checker.check(), checker.notes
+    except Exception as e:
+        return [u"Unable to check the scenario: {}\n{}".format(e, traceback.format_exc())], []
+
+
+def _check_scenario(scenario_file):
+    errors, notes = check_scenario(scenario_file)
+    return scenario_file, errors, notes
+
+
+def check_scenarios(scenario_files, jobs=1):
+    """
+    Check several scenario files without running them, using a pool of `jobs` worker processes
+
+    Return a boolean (True if at least one scenario has errors, else False)
+    """
+    pool = None
+    failures = []
+    try:
+        if jobs > 1:
+            pool = Pool(processes=jobs)
+            results = pool.imap(_check_scenario, scenario_files)
+        else:
+            results = (_check_scenario(scenario_file) for scenario_file in scenario_files)
+
+        for scenario_file, errors, notes in results:
+            if errors:
+                failures.append(scenario_file)
+                print u"{}{}FAILED: {}{}".format(ju.error_color, ju.bold, scenario_file, ju.end_color)
+                for error in errors:
+                    print u"{}  {}{}".format(ju.error_color, error, ju.end_color)
+            else:
+                print u"{}OK: {}{}".format(ju.success_color, scenario_file, ju.end_color)
+            for note in notes:
+                print u"{}  note: {}{}".format(ju.warning_color, note, ju.end_color)
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
+
+    print "\n{}{} scenario(s) checked, {} with errors{}".format(
+        ju.bold, len(scenario_files), len(failures), ju.end_color)
+    return len(failures) > 0
@@ -0,0 +1,301 @@
+import os
+import re
+import sys
+import threading
+import traceback
+import Queue
+
+from multiprocessing.pool import ThreadPool
+from StringIO import StringIO
+
+expression_matcher = re.compile("{{([^{}]*)}}")
+# the first element of a jsonpath expression once its `$.` is removed: `name.key`, `name[0]`, `name.*.id as list`...
+expression_name = re.compile(r"^([^.\[\s*]+)")
+# the first element given in brackets: `$['my-name'].key`, `["name"]`
+expression_bracket_name = re.compile(r"""^\$?\[\s*(['"])(.+?)\1\s*\]""")
+# references to the saved results from python code (eval_expr, pre_eval_expr, repeat expressions)
+code_expr = re.compile(r"""expr\(\s*(['"])(.*?)\1""")
+code_saved_results = re.compile(r"""saved_results\s*(?:\[\s*|\.get\(\s*)['"]([^'"]+)['"]""")
+
+# keys whose value is python code
+CODE_KEYS = ('eval_expr', 'pre_eval_expr')
+# keys whose expressions apply to the result of the command itself
+RESULT_KEYS = ('print_result', 'check_order')
+# these keys have side effects that cannot be ordered, such commands are run alone
+BARRIER_KEYS = ('hooks', 'post_delay')
+# names written by every command in the saved results
+RESERVED_NAMES = ('body', 'result')
+
+# the worker pools of the threads running graphs, kept so that their threads reuse their services
+_pools = threading.local()
+
+
+def expression_root(expression):
+    """
+    The saved result a jsonpath expression starts from, None when it may read any of them
+
+    The descendant (`$..id`), wildcard (`$.*`), filter and index roots may
+    match any saved result.
+    """
+    expression = expression.strip()
+    if expression.endswith("as list"):
+        expression = expression[:-len("as list")].strip()
+
+    match = expression_bracket_name.match(expression)
+    if match:
+        return match.group(2)
+    if expression.startswith('$'):
+        expression = expression[1:]
+        if expression.startswith('.') and not expression.startswith('..'):
+            expression = expression[1:]
+    match = expression_name.match(expression)
+    return match.group(1) if match else None
+
+
+class CommandDependencies(object):
+    """
+    The saved results read and written by a command
+    """
+    def __init__(self):
+        self.reads = set()
+        self.writes = set()
+        self.barrier = False
+        # the command may read any saved result
+        self.reads_all = False
+        # the command may save any result
+        self.writes_all = False
+
+    def depends_on(self, other):
+        """
+        Tell if this command has to wait for `other`, a command defined before it
+        """
+        if self.barrier or other.barrier:
+            return True
+        return bool(other.writes & (self.reads | self.writes) or other.reads & self.writes)
+
+
+def _code_references(code, deps):
+    if isinstance(code, list):
+        for c in code:
+            _code_references(c, deps)
+        return
+
+    if not isinstance(code, basestring):
+        return
+
+    names = set(code_saved_results.findall(code))
+    for _, expression in code_expr.findall(code):
+        name = expression_root(expression)
+        if name is None:
+            deps.reads_all = True
+        else:
+            names.add(name)
+    # saved_results is used in a way we cannot analyze
+    if len(re.findall(r"saved_results", code)) > len(code_saved_results.findall(code)):
+        deps.reads_all = True
+        deps.writes_all = True
+    if deps.reads_all:
+        deps.barrier = True
+
+    # the code may both read and write these results
+    deps.reads |= names
+    deps.writes |= names
+
+
+def _value_references(value, deps, load_file=None):
+    if isinstance(value, dict):
+        for val in value.itervalues():
+            _value_references(val, deps, load_file)
+    elif isinstance(value, list):
+        for val in value:
+            _value_references(val, deps, load_file)
+    elif isinstance(value, basestring):
+        expressions = expression_matcher.findall(value)
+        if not expressions and load_file:
+            # the value may be a json file containing expressions
+            content = load_file(value)
+            if content:
+                expressions = expression_matcher.findall(content)
+
+        for expression in expressions:
+            name = expression_root(expression)
+            if name is None:
+                deps.reads_all = True
+                deps.barrier = True
+            else:
+                deps.reads.add(name)
+
+
+def command_dependencies(command, load_file=None):
+    """
+    Compute the saved results a command reads and writes
+
+    `load_file` is called with the string values of `body` and `check_result`,
+    it returns the content of the file they reference, or None.
+    """
+    deps = CommandDependencies()
+
+    if isinstance(command, basestring):
+        return deps
+
+    for key, val in command.iteritems():
+        if key in BARRIER_KEYS:
+            deps.barrier = True
+        elif key in RESULT_KEYS:
+            continue
+        elif key in CODE_KEYS:
+            _code_references(val, deps)
+        elif key == 'repeat':
+            _code_references(val.get('conditions', {}).get('expression'), deps)
+        elif key == 'save_result':
+            deps.writes.add(val.get('name') if isinstance(val, dict) else val)
+        elif key == 'batch':
+            # the commands of a batch are run together
+            for sub_command in (val.get('commands', []) if isinstance(val, dict) else val):
+                sub_deps = command_dependencies(sub_command, load_file)
+                deps.reads |= sub_deps.reads
+                deps.writes |= sub_deps.writes
+                deps.barrier = deps.barrier or sub_deps.barrier
+                deps.reads_all = deps.reads_all or sub_deps.reads_all
+                deps.writes_all = deps.writes_all or sub_deps.writes_all
+        elif key == 'depends_on':
+            deps.reads |= set(val if isinstance(val, list) else [val])
+        elif key == 'check_result':
+            _value_references(val, deps, load_file)
+        elif isinstance(val, dict):
+            # the endpoint arguments
+            for arg, arg_val in val.iteritems():
+                _value_references(arg_val, deps, load_file if arg == 'body' else None)
+        else:
+            _value_references(val, deps)
+
+    if deps.reads & set(RESERVED_NAMES):
+        deps.barrier = True
+
+    return deps
+
+
+def build_graph(commands, load_file=None):
+    """
+    Build the dependency graph of a list of commands
+
+    Returns a list holding, for each command, the set of the indexes of the
+    commands it has to wait for.
+    """
+    deps = [command_dependencies(command, load_file) for command in commands]
+    graph = []
+    for idx, command_deps in enumerate(deps):
+        graph.append(set(prev for prev in xrange(idx) if command_deps.depends_on(deps[prev])))
+    return graph
+
+
+class ThreadLocalOutput(object):
+    """
+    A replacement for sys.stdout letting each thread buffer its own output
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def capture(self):
+        self.local.buffer = StringIO()
+
+    def release(self):
+        output = self.local.buffer.getvalue()
+        self.local.buffer = None
+        return output
+
+    def write(self, data):
+        buf = getattr(self.local, 'buffer', None)
+        if buf is not None:
+            buf.write(data)
+        else:
+            self.stream.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+def get_pool(workers):
+    """
+    Return the pool of `workers` threads of the calling thread, created once per thread and process
+    """
+    pool = getattr(_pools, 'pool', None)
+    if pool is None or _pools.key != (os.getpid(), workers):
+        if pool is not None and _pools.key[0] == os.getpid():
+            pool.close()
+        pool = _pools.pool = ThreadPool(processes=workers)
+        _pools.key = (os.getpid(), workers)
+    return pool
+
+
+def _drop_pool():
+    pool = getattr(_pools, 'pool', None)
+    if pool is not None:
+        _pools.pool = None
+        pool.terminate()
+        pool.join()
+
+
+def run_graph(graph, run, workers, stop_on_error=False):
+    """
+    Call `run(idx)` for each node of the graph, using a pool of `workers` threads
+
+    A node is run once all the nodes it depends on are done. `run` returns
+    True when an error occurred. The output of each call is buffered and
+    printed at once when it is done.
+
+    Return a boolean (True if an error occurred, else False)
+    """
+    stdout = sys.stdout
+    output = ThreadLocalOutput(stdout)
+    done = Queue.Queue()
+
+    def task(idx):
+        output.capture()
+        try:
+            error = run(idx)
+        except Exception:
+            print traceback.format_exc()
+            error = True
+        return idx, error, output.release()
+
+    waiting = dict((idx, set(deps)) for idx, deps in enumerate(graph))
+    running = set()
+    error = False
+
+    pool = get_pool(workers)
+    sys.stdout = output
+    try:
+        while waiting or running:
+            if not error or not stop_on_error:
+                for idx in sorted(idx for idx, deps in waiting.iteritems() if not deps):
+                    del waiting[idx]
+                    running.add(idx)
+                    pool.apply_async(task, (idx,), callback=done.put)
+
+            if not running:
+                # nothing left we are allowed to run
+                break
+
+            # a timeout keeps the main thread responsive to KeyboardInterrupt
+            idx, failed, out = None, None, None
+            while idx is None:
+                try:
+                    idx, failed, out = done.get(timeout=1)
+                except Queue.Empty:
+                    pass
+
+            stdout.write(out)
+            running.discard(idx)
+            error = error or failed
+            for deps in waiting.itervalues():
+                deps.discard(idx)
+    except BaseException:
+        # the tasks still running are dropped with their threads
+        _drop_pool()
+        raise
+    finally:
+        sys.stdout = stdout
+
+    return error
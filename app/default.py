@@ -4,17 +4,26 @@ import os
 import sys
 import json
 import re
-import yaml
 import time
-import apiclient
-
-from httplib import BadStatusLine
-
-from httplib2 import Http
-from apiclient.discovery import build
-from oauth2client.service_account import ServiceAccountCredentials
+import threading
 
 from app.utils import check_order_values
+from app import cassette
+from app import concurrency
+from app import discovery
+from app import files
+from app.template import Template, load_template
+from app.results import Exporter, ResultStore, peak_memory, project
+from app import pagination
+from app import timing
+from app import latency
+from app import mock
+from app import report
+from app import retry
+from app import startup
+from app.latency import LatencyCheck
+from app.pagination import Paginator
+from app.retry import RetryPolicy, backoff_delay
 from jsonpath import jsonpath
 import utils as ju
 from utils import pretty_json, check_json
@@ -23,55 +32,168 @@ from utils import pretty_json, check_json
 __version__ = '0.111'
 
 
+# the services are not thread safe, each thread has its own pool
+_service_pool = threading.local()
+# credentials are shared, they keep their access token until it expires
+_credentials_pool = {}
+_pool_lock = threading.Lock()
+_pool_stats = {'hits': 0, 'misses': 0}
+
+# the number of requests sent in a single batch request by default, and the limit of the api client
+DEFAULT_BATCH_SIZE = 100
+MAX_BATCH_SIZE = 1000
+# the options a command of a batch can use
+BATCH_OPTIONS = ('save_result', 'check_code', 'check_result', 'print_result', 'description')
+
+
+def _get_credentials(auth_config):
+    key = json.dumps(auth_config, sort_keys=True)
+    with _pool_lock:
+        if key not in _credentials_pool:
+            with startup.profile.step('import oauth2client'):
+                from oauth2client.service_account import ServiceAccountCredentials
+            with startup.profile.step('credentials'):
+                credentials = ServiceAccountCredentials.from_p12_keyfile(
+                    auth_config['client_id'], auth_config['client_secret'],
+                    scopes=auth_config['oauth_scope']
+                )
+                if 'email' in auth_config:
+                    credentials = credentials.create_delegated(auth_config['email'])
+            _credentials_pool[key] = credentials
+        return _credentials_pool[key]
+
+
 def get_service(service_config, auth_config=None, provider="GOOGLE"):
-    if provider == "GOOGLE":
-        if auth_config:
-            credentials = ServiceAccountCredentials.from_p12_keyfile(
-                auth_config['client_id'], auth_config['client_secret'],
-                scopes=auth_config['oauth_scope']
-            )
-            if 'email' in auth_config:
-                delegated_credentials = credentials.create_delegated(auth_config['email'])
-                http_auth = delegated_credentials.authorize(Http())
-            else:
-                http_auth = credentials.authorize(Http())
+    """
+    Return the service for a configuration, the services are built once per thread
+    """
+    key = json.dumps([provider, service_config, auth_config or None], sort_keys=True)
+    services = getattr(_service_pool, 'services', None)
+    if services is None:
+        services = _service_pool.services = {}
 
-            build_optional_cfg = {'http': http_auth, 'cache_discovery': False}
-            if service_config['discovery_url']:
-                build_optional_cfg['discoveryServiceUrl'] = service_config['discovery_url']
+    with _pool_lock:
+        _pool_stats['hits' if key in services else 'misses'] += 1
 
-            service = build(service_config['api'], service_config['version'], **build_optional_cfg)
-            return service
-        else:
-            return build(service_config['api'], service_config['version'],
-                         discoveryServiceUrl=service_config['discovery_url'], cache_discovery=False)
+    if key not in services:
+        services[key] = build_service(service_config, auth_config, provider)
+    return services[key]
+
+
+def get_method(service, key):
+    """
+    Return the method of the service for an endpoint key like `resource.sub_resource.method`
+
+    The resources are walked once per service and endpoint, the method is
+    then kept by the service so that it is dropped with it.
+    """
+    methods = service.__dict__.setdefault('_lumrest_methods', {})
+    if key not in methods:
+        path = key.split('.')
+        resource = service
+        for name in path[:-1]:
+            resource = getattr(resource, name)()
+        methods[key] = getattr(resource, path[-1])
+    return methods[key]
+
+
+def describe_call(key, args):
+    """
+    A readable version of an endpoint call, for the error messages
+    """
+    return "{}({})".format(key, ", ".join("{}={!r}".format(arg, val) for arg, val in sorted(args.iteritems())))
+
+
+def execute(method, key, args, policy=None):
+    """
+    Call an endpoint, it is called again as long as the retry policy allows it
+    """
+    policy = policy or retry.default_policy
+    return policy.call(lambda: method(**args).execute(), lambda: describe_call(key, args))
+
+
+def command_key(command):
+    """
+    The endpoint key of a command, `batch` for a batch of commands
+    """
+    if not isinstance(command, dict) or not command:
+        return None
+    if 'batch' in command:
+        return 'batch'
+    # the endpoint keys are the only dotted keys of a command
+    keys = [key for key in command if '.' in key]
+    return keys[0] if keys else command.keys()[0]
+
+
+def baseline_keys(commands):
+    """
+    The keys of the commands in the latency baselines, their endpoint key and occurrence: `items.get:2`
+
+    Unlike their position, they do not change when other commands are inserted.
+    """
+    keys = []
+    occurrences = {}
+    for command in commands:
+        key = command if isinstance(command, basestring) else command_key(command)
+        occurrences[key] = occurrences.get(key, 0) + 1
+        keys.append(u'{}:{}'.format(key, occurrences[key]))
+    return keys
+
+
+def parse_save_result(save_result):
+    """
+    Return the name of a saved result and the jsonpath expressions of the parts to keep, if any
+    """
+    keep = None
+    if isinstance(save_result, dict):
+        keep = save_result.get('keep')
+        if isinstance(keep, basestring):
+            keep = [keep]
+        save_result = save_result.get('name')
+    if not isinstance(save_result, basestring):
+        raise ValueError("save_result must be a name or a dict with a `name` key")
+    return save_result, keep
+
+
+def service_pool_stats():
+    """
+    The number of services reused from the pool (hits) and built (misses)
+    """
+    with _pool_lock:
+        return dict(_pool_stats)
+
+
+def build_service(service_config, auth_config=None, provider="GOOGLE"):
+    if provider == "GOOGLE":
+        # the api client is only imported once a scenario needs it
+        with startup.profile.step('import api client'):
+            from apiclient.discovery import build_from_document
+
+        with startup.profile.step('discovery document'):
+            document = mock.get_document(service_config) or discovery.get_document(
+                service_config['api'], service_config['version'], service_config.get('discovery_url'))
+        # the credentials are not needed when the responses are replayed or mocked
+        http = cassette.new_http(lambda http: _get_credentials(auth_config).authorize(http) if auth_config else http,
+                                 document=document)
+        with startup.profile.step('build service'):
+            return build_from_document(document, http=http)
 
 
 class CommandParser():
     """
     The Parser class
     """
-    _foundpaths = []
     def get_filepath(self, scene_root, path, strict=True):
-        paths = [re.sub(r'^\./', scene_root, path), os.path.abspath(path), os.path.abspath(os.path.join(scene_root, path))]
-        paths.extend([os.path.abspath(os.path.join(folder, path)) for folder in self._foundpaths])
-        for path in paths:
-            if os.path.isfile(path):
-                # we don't keep track of the file where the command is kept
-                # thus we need an hack to keep track of the found files which could reference it
-                # !!! the resulting path could be ambiguous
-                _, ext = os.path.splitext(path)
-                if ext == '.yaml':
-                    self._foundpaths.append(os.path.dirname(path))
-                return path
-        if strict:
-            raise RuntimeError("{} cannot be found in any of the hintpaths ({})".format(path, paths))
-
-    def __init__(self, config, scene, scene_root, exit_on_error=False):
-        self.output_results = {}
+        return files.find_file(scene_root, path, strict=strict)
+
+    def __init__(self, config, scene, scene_root, exit_on_error=False, scenario_file=None):
+        self.output_results = ResultStore()
         self.expression_matcher = re.compile("{{([^{}]*)}}")
         self.scenario = scene
         self.scenario_root = scene_root
+        # the recorded requests are told apart by scenario file, by name for a scenario read from stdin
+        self.cassette_scope = cassette.scenario_scope(scenario_file) if scenario_file else \
+            scene.get('name', scene_root)
         self.config = dict(config)
         self.exit_on_error = exit_on_error
         self.hooks = {
@@ -80,6 +202,20 @@ class CommandParser():
         }
         self.imports = []
         self.setup_commands = []
+        self.teardown_commands = []
+        self.concurrency = 0
+        self.print_limit = None
+        # called with the endpoint key, the duration in ms and the status of each request
+        self.request_listeners = []
+        # the default latency bounds of the commands, the budget of the scenario and the baseline file
+        self.latency_check = None
+        self.latency_budget = None
+        self.latency_total = 0
+        self.baseline = None
+        self.baseline_threshold = 0.2
+        # the baseline key of each command, by position
+        self.baseline_keys = []
+        self.retry_policy = retry.default_policy
 
         if 'debug' in self.config:
             self.debug = self.config['debug']
@@ -92,8 +228,50 @@ class CommandParser():
         if 'commands' not in scene:
             scene['commands'] = []
 
-        # authenticate
-        self.service = get_service(scene['service'], config.get('auth', None))
+        if 'concurrency' in scene:
+            concurrency_config = scene['concurrency']
+            if isinstance(concurrency_config, dict):
+                concurrency_config = concurrency_config.get('workers', 0)
+
+            if not isinstance(concurrency_config, int) or concurrency_config < 0:
+                raise ValueError("Concurrency must be a positive number of workers")
+
+            self.concurrency = concurrency_config
+
+        if 'results' in scene:
+            results_config = scene['results']
+            if not isinstance(results_config, dict):
+                raise ValueError("results must be a dict")
+
+            spill = results_config.get('spill')
+            spill_after = 10
+            if isinstance(spill, dict):
+                spill_after = spill.get('after', spill_after)
+                spill = spill.get('folder', True)
+            self.output_results = ResultStore(evict=results_config.get('evict', False),
+                                              spill=spill, spill_after=spill_after)
+
+        if 'check_latency' in scene:
+            latency_config = scene['check_latency']
+            if not isinstance(latency_config, dict):
+                raise ValueError("The scenario check_latency must be a dict")
+
+            latency_config = dict(latency_config)
+            self.latency_budget = latency_config.pop('total_ms', None)
+            self.baseline_threshold = latency_config.pop('threshold', self.baseline_threshold)
+            baseline = latency_config.pop('baseline', None)
+            if baseline:
+                self.baseline = latency.get_baseline(os.path.join(scene_root, baseline))
+            if latency_config:
+                self.latency_check = LatencyCheck(latency_config)
+
+        if 'retry' in scene:
+            self.retry_policy = RetryPolicy(scene['retry'])
+
+        if 'print_limit' in scene:
+            self.print_limit = scene['print_limit']
+            if not isinstance(self.print_limit, int) or self.print_limit <= 0:
+                raise ValueError("print_limit must be a positive number of characters")
 
         if 'hooks' in scene:
             hooks = scene['hooks']
@@ -114,15 +292,10 @@ class CommandParser():
 
             for setup_file in setup:
                 setup_file = self.get_filepath(scene_root, setup_file)
+                setup_yml = files.load_include(setup_file)
 
-                with open(setup_file, 'r') as f:
-                    f_content = f.read()
-                    f_content = re.sub(r'(\s+body:\s*)\.\/(.*json)',
-                                       r'\1{}/\2'.format(os.path.split(os.path.abspath(setup_file))[0]), f_content)
-                    setup_yml = yaml.load(f_content)
-
-                    if 'commands' in setup_yml:
-                        self.setup_commands.extend(setup_yml['commands'])
+                if 'commands' in setup_yml:
+                    self.setup_commands.extend(setup_yml['commands'])
 
         if 'import' in scene:
             imports = scene['import']
@@ -134,14 +307,12 @@ class CommandParser():
 
             for import_file in imports:
                 import_file = self.get_filepath(scene_root, import_file)
-
-                with open(import_file, 'r') as f:
-                    f_content = f.read()
-                    f_content = re.sub(r'(\s+body:\s*)\.\/(.*json)',
-                                       r'\1{}/\2'.format(os.path.split(os.path.abspath(import_file))[0]), f_content)
-                    setup_yml = yaml.load(f_content)
-                    self.imports.append(
-                        CommandParser(config, setup_yml, self.scenario_root, exit_on_error=exit_on_error))
+                setup_yml = files.load_include(import_file)
+                import_parser = CommandParser(config, setup_yml, self.scenario_root, exit_on_error=exit_on_error,
+                                              scenario_file=import_file)
+                # the imported scenarios notify the same listeners
+                import_parser.request_listeners = self.request_listeners
+                self.imports.append(import_parser)
 
         # if we have teardown includes, append them
         if 'teardown' in scene:
@@ -154,12 +325,10 @@ class CommandParser():
 
             for teardown_file in teardown:
                 teardown_file = self.get_filepath(scene_root, teardown_file)
+                teardown_yml = files.load_include(teardown_file, relative_bodies=False)
 
-                with open(teardown_file, 'r') as f:
-                    teardown_yml = yaml.load(f)
-
-                    if 'commands' in teardown_yml:
-                        scene['commands'].extend(teardown_yml['commands'])
+                if 'commands' in teardown_yml:
+                    self.teardown_commands.extend(teardown_yml['commands'])
 
     def parse(self):
         """
@@ -191,6 +360,52 @@ class CommandParser():
         - `check_result`: given a json file, uses `json_utils.check_json()`
             to check that the result respects its pattern.
 
+        Return a boolean (True if an error occurred, else False)
+        """
+        commands = self.scenario.get('commands', [])
+        all_commands = self.setup_commands + commands + self.teardown_commands
+        self.output_results.plan(all_commands, load_file=self.__read_file)
+        self.baseline_keys = baseline_keys(all_commands)
+        name = self.scenario.get('name', self.scenario_root)
+        error = True
+        start = time.time()
+        report.reporter.scenario_start(name)
+        cassette_scope = cassette.get_scope()
+        cassette.set_scope(self.cassette_scope)
+        try:
+            error = self.__parse_scenario(commands)
+            if error and self.exit_on_error:
+                return error
+
+            if self.latency_budget is not None:
+                if not ju.light_assert(self.latency_total <= self.latency_budget,
+                                       u'The requests of {} took {:.0f}ms, more than the budget of {}ms'.format(
+                                           name, self.latency_total, self.latency_budget)):
+                    error = True
+            return error
+        finally:
+            report.reporter.scenario_end(name, error, time.time() - start)
+            cassette.set_scope(cassette_scope)
+            cassette.save()
+            if self.baseline:
+                self.baseline.save()
+            self.output_results.close()
+            if self.output_results.planned:
+                stats = self.output_results.stats
+                if stats['memory'] is not None:
+                    memory = "resident memory {:.1f}MB at most, {:+.1f}MB from the start".format(
+                        stats['max_memory'], stats['max_memory'] - stats['memory'])
+                else:
+                    memory = "process peak memory {:.1f}MB".format(peak_memory())
+                print "Saved results of {}: {} at most, {} evicted, {} spilled, {}".format(
+                    name, stats['peak'], stats['evicted'], stats['spilled'], memory)
+            if timing.settings['summary']:
+                timing.timings.print_summary(name)
+
+    def __parse_scenario(self, commands):
+        """
+        Run the setup, imports, commands and teardown of the scenario
+
         Return a boolean (True if an error occurred, else False)
         """
         if self.hooks.get("setup"):
@@ -209,7 +424,12 @@ class CommandParser():
 
         print "Running scenario {} commands".format(self.scenario.get('name', self.scenario_root))
 
-        error = self.__parse_commands(self.scenario.get('commands', []))
+        error = self.__parse_commands(commands, offset=len(self.setup_commands))
+        if error and self.exit_on_error:
+            return error
+
+        error = self.__parse_commands(self.teardown_commands,
+                                      offset=len(self.setup_commands) + len(commands)) or error
         if error and self.exit_on_error:
             return error
 
@@ -218,71 +438,304 @@ class CommandParser():
 
         return error
 
-    def __parse_commands(self, commands):
+    def __parse_commands(self, commands, offset=0):
         """
         Execute a list of commands.
         If an error occurred, and exit_on_error is set to True, error code will immediately be returned.
 
+        When the scenario sets `concurrency`, the commands not depending on each other are run in parallel.
+
         Args:
             commands: the list of commands to execute
+            offset: the position of the first command in the scenario
         Returns:
             True if an error occurred, else False.
         """
+        if self.concurrency > 1 and len(commands) > 1:
+            graph = concurrency.build_graph(commands, load_file=self.__read_file)
+            return concurrency.run_graph(graph, lambda idx: self.__run_command(commands[idx], offset + idx),
+                                         self.concurrency, stop_on_error=self.exit_on_error)
+
         error = False
-        for command in commands:
-            try:
-                if isinstance(command, unicode) or isinstance(command, str):
-                    command = {command: []}
-
-                service = self.service
-                # change the auth temporarily
-                if 'config' in command:
-                    config = dict(self.config)
-                    service_config = self.scenario['service']
-                    if 'auth' in command['config']:
-                        if command['config']['auth']:
-                            for key, val in command['config']['auth'].iteritems():
-                                if isinstance(val, unicode) or isinstance(val, str):
-                                    config['auth'][key] = self.eval_expr(val)
-                                else:
-                                    config['auth'][key] = val
-                        else:
-                            config['auth'] = None
+        for idx, command in enumerate(commands):
+            error = self.__run_command(command, offset + idx) or error
+            if error and self.exit_on_error:
+                return error
+
+        return error
+
+    def __run_command(self, command, position):
+        """
+        Execute a single command, with its own configuration if any
+
+        Args:
+            command: the command to execute
+            position: the position of the command in the scenario
+        Returns:
+            True if an error occurred, else False.
+        """
+        error = False
+        message = None
+        if isinstance(command, unicode) or isinstance(command, str):
+            command = {command: []}
+        key = command_key(command)
+        scenario_name = self.scenario.get('name', self.scenario_root)
+        start = time.time()
+        report.reporter.command_start(scenario_name, position, key)
+        # the command may run in a worker thread
+        cassette.set_scope(self.cassette_scope)
+        self.output_results.before(position)
+        try:
+
+            command.pop('depends_on', None)
+
+            service = self.__default_service()
+            # returns the service of the current thread, for the pages fetched in the background
+            new_service = self.__default_service
+            # change the auth temporarily
+            if 'config' in command:
+                config = dict(self.config)
+                service_config = dict(self.scenario['service'])
+                if 'auth' in command['config']:
+                    if command['config']['auth']:
+                        config['auth'] = dict(config.get('auth') or {})
+                        for name, val in command['config']['auth'].iteritems():
+                            if isinstance(val, unicode) or isinstance(val, str):
+                                config['auth'][name] = self.eval_expr(val)
+                            else:
+                                config['auth'][name] = val
+                    else:
+                        config['auth'] = None
+
+                if 'service' in command['config']:
+                    for name, val in command['config']['service'].iteritems():
+                        service_config[name] = self.eval_expr(val)
+
+                service = get_service(service_config, config.get('auth', None))
+                new_service = lambda: get_service(service_config, config.get('auth', None))
+                command.pop('config')
+
+            delay = None
+            if 'post_delay' in command:
+                delay = command.pop('post_delay')
+
+            if 'batch' in command:
+                error = self.__run_batch(command['batch'], service)
+            else:
+                self.__parse_command(command, service, self.scenario_root, new_service=new_service,
+                                     position=position)
+
+            if delay:
+                print "Wait {} seconds".format(delay)
+                time.sleep(delay)
+        except AssertionError as e:
+            message = unicode(e.message)
+            error = True
+        except Exception as e:
+            report.reporter.flush()
+            print "{}{}Unable to execute command:{} {}{}{}\n{}{}{}\n".format(
+                ju.error_color, ju.bold, ju.end_color,
+                ju.error_color_detail, key,
+                ju.error_color, ju.bold, e, ju.end_color)
+            print traceback.format_exc()
+            message = unicode(e)
+            error = True
+        finally:
+            self.output_results.after(position)
+            report.reporter.command_end(scenario_name, position, key, error, time.time() - start, message)
+
+        return error
+
+    def notify_request(self, key, elapsed, status, expected=200):
+        """
+        Tell the request listeners an endpoint was called, `expected` is the status the command checks
+        """
+        for listener in self.request_listeners:
+            listener(key, elapsed, status, expected)
 
-                    if 'service' in command['config']:
-                        for key, val in command['config']['service'].iteritems():
-                            service_config[key] = self.eval_expr(val)
+    def __default_service(self):
+        """
+        The scenario service, each thread gets its own as they are not thread safe
+        """
+        return get_service(self.scenario['service'], self.config.get('auth', None))
+
+    def __read_file(self, path):
+        """
+        Return the content of a file referenced by a command, None if it cannot be found
+        """
+        path = self.get_filepath(self.scenario_root, path, strict=False)
+        if not path:
+            return None
+
+        return files.read_file(path)
+
+    def __run_batch(self, batch, service):
+        """
+        Send a list of commands as batch requests, each batch request holding `size` commands at most
+
+        Returns:
+            True if an error occurred, else False.
+        """
+        if isinstance(batch, list):
+            batch = {'commands': batch}
+        if not isinstance(batch, dict) or not isinstance(batch.get('commands'), list):
+            raise ValueError("A batch must be either a list of commands or a dict with a `commands` list")
+
+        size = batch.get('size', DEFAULT_BATCH_SIZE)
+        if not isinstance(size, int) or size < 1 or size > MAX_BATCH_SIZE:
+            raise ValueError("The batch size must be between 1 and {}".format(MAX_BATCH_SIZE))
 
-                    service = get_service(service_config, config.get('auth', None))
-                    command.pop('config')
+        commands = batch['commands']
+        error = False
+        for start in xrange(0, len(commands), size):
+            error = self.__run_batch_requests(commands[start:start + size], service) or error
+            if error and self.exit_on_error:
+                break
 
-                delay = None
-                if 'post_delay' in command:
-                    delay = command.pop('post_delay')
+        return error
 
-                self.__parse_command(command, service, self.scenario_root)
+    def __run_batch_requests(self, commands, service):
+        """
+        Send the commands in a single batch request, then check each response
 
-                if delay:
-                    print "Wait {} seconds".format(delay)
-                    time.sleep(delay)
+        Returns:
+            True if an error occurred, else False.
+        """
+        requests = []
+        for command in commands:
+            if isinstance(command, unicode) or isinstance(command, str):
+                command = {command: {}}
+
+            options = dict((option, command.pop(option)) for option in BATCH_OPTIONS if option in command)
+            if len(command.keys()) != 1:
+                raise ValueError("A command of a batch must have one endpoint and only the {} options.\n{}".format(
+                    ", ".join(BATCH_OPTIONS), "\n".join(['- {}'.format(k) for k in command])))
+
+            key = command.keys()[0]
+            args = {}
+            for arg, val in (command[key] or {}).iteritems():
+                if arg == 'body':
+                    template = self.__body_template(val)
+                    if template:
+                        val = template.render(self.__parse_expression, copy=True)
+                elif isinstance(val, basestring):
+                    val = self.eval_expr(val)
+                elif isinstance(val, list):
+                    val = [self.eval_expr(v) if isinstance(v, basestring) else v for v in val]
+                args[arg] = val
+            requests.append((key, args, options))
+
+        responses = {}
+
+        def callback(request_id, response, exception):
+            responses[request_id] = (response, exception)
+
+        http_batch = service.new_batch_http_request(callback=callback)
+        for idx, (key, args, _) in enumerate(requests):
+            http_batch.add(get_method(service, key)(**args), request_id=str(idx))
+
+        print "\n{}{}Executing a batch of {} request(s){}".format(ju.bold, ju.yellow, len(requests), ju.end_color)
+        startup.profile.request_sent()
+        exec_time = time.time()
+        http_batch.execute()
+        elapsed = (time.time() - exec_time) * 1000
+        print "Done in {}ms".format(int(round(elapsed)))
+        self.notify_request('batch', elapsed, 200)
+        self.latency_total += elapsed
+        self.__add_time(None, 'batch', 'http', elapsed / 1000)
+
+        error = False
+        for idx, (key, args, options) in enumerate(requests):
+            result, exception = responses.get(str(idx), (None, None))
+            try:
+                self.__check_batch_response(key, args, options, result, exception)
             except AssertionError:
                 error = True
             except Exception as e:
                 print "{}{}Unable to execute command:{} {}{}{}\n{}{}{}\n".format(
                     ju.error_color, ju.bold, ju.end_color,
-                    ju.error_color_detail, command.keys()[0],
+                    ju.error_color_detail, key,
                     ju.error_color, ju.bold, e, ju.end_color)
-                print traceback.format_exc()
                 error = True
-            finally:
-                if error and self.exit_on_error:
-                    return error
+
+            if error and self.exit_on_error:
+                break
 
         return error
 
-    def __parse_command(self, command, service, scenario_root):
-        json_pattern = None
+    def __check_batch_response(self, key, args, options, result, exception):
+        """
+        Apply the options of a command of a batch to its response
+        """
+        print "\n{}{}Response of : {}{}".format(ju.bold, ju.yellow, key, ju.end_color)
+        if options.get('description'):
+            print "Description: {}\n".format(unicode(options['description']))
+
+        check_code = options.get('check_code', 200)
+        status = 200
+        if exception:
+            status = exception.resp["status"] if hasattr(exception, 'resp') else None
+            result = None
+
+        if str(status) != str(check_code):
+            raise RuntimeError("The executed command was: {}\nMessage: {}".format(
+                describe_call(key, args),
+                exception or "HTTP status code is {} and expected is {}.".format(status, check_code)))
+
+        if 'save_result' in options and result:
+            result_name, keep = parse_save_result(options['save_result'])
+            self.output_results[result_name] = project(result, keep) if keep else result
+
+        if 'print_result' in options and result:
+            self.__print_result(options['print_result'], result)
+
+        if 'check_result' in options:
+            check_json_val = options['check_result']
+            if isinstance(check_json_val, dict):
+                json_template = Template(check_json_val)
+            else:
+                json_template = load_template(self.get_filepath(self.scenario_root, check_json_val))
+
+            if json_template.value:
+                try:
+                    check_json(result, json_template.render(self.__parse_expression), exit_on_error=self.exit_on_error)
+                finally:
+                    report.reporter.flush()
+
+    def __fetch_page(self, get_service, key, endpoint_args, token_arg, token, policy=None):
+        """
+        Fetch a following page of a paginated command, `get_service` returns the service of the calling thread
+        """
+        # the page may be prefetched by a thread of the pagination pool
+        cassette.set_scope(self.cassette_scope)
+        args = dict(endpoint_args)
+        args[token_arg] = token
+        exec_time = time.time()
+        try:
+            page = execute(get_method(get_service(), key), key, args, policy)
+        except Exception as e:
+            raise RuntimeError("The executed command was: {}\nMessage: {}".format(describe_call(key, args), e))
+        self.notify_request(key, (time.time() - exec_time) * 1000, 200)
+        return page
+
+    def __record_time(self, position, key, phase, started):
+        """
+        Record the time spent in a phase of a command since `started`
+        """
+        self.__add_time(position, key, phase, time.time() - started)
+
+    def __add_time(self, position, key, phase, seconds, calls=1):
+        """
+        Record the time spent in a phase of a command
+        """
+        scenario_name = self.scenario.get('name', self.scenario_root)
+        timing.timings.add(scenario_name, position, key, phase, seconds, calls)
+        report.reporter.timing(scenario_name, position, key, phase, seconds, calls)
+
+    def __parse_command(self, command, service, scenario_root, new_service=None, position=None):
+        json_template = None
         result_name = None
+        keep = None
         print_result = False
         print_body = False
         export_result = None
@@ -294,21 +747,20 @@ class CommandParser():
         description = None
         order = None
         hooks = None
+        paginator = None
         body_to_print = False
 
         # load the check_result json file if provided
         if 'check_result' in command:
             check_json_val = command.pop('check_result')
             if isinstance(check_json_val, dict):
-                json_pattern = check_json_val
+                json_template = Template(check_json_val)
             elif isinstance(check_json_val, str) or isinstance(check_json_val, unicode):
                 check_json_file = self.get_filepath(self.scenario_root, check_json_val)
-
-                with open(check_json_file, 'r') as check:
-                    json_pattern = json.load(check)
+                json_template = load_template(check_json_file)
 
         if 'save_result' in command:
-            result_name = command.pop('save_result')
+            result_name, keep = parse_save_result(command.pop('save_result'))
 
         if 'check_code' in command:
             check_code = command.pop('check_code')
@@ -323,7 +775,7 @@ class CommandParser():
             print_body = command.pop('print_body')
 
         if 'export_result' in command:
-            export_result = command.pop('export_result')
+            export_result = Exporter(command.pop('export_result'))
 
         if 'eval_expr' in command:
             eval_expr = command.pop('eval_expr')
@@ -343,25 +795,39 @@ class CommandParser():
         if 'hooks' in command:
             hooks = command.pop('hooks')
 
+        if 'paginate' in command:
+            paginator = Paginator(command.pop('paginate'))
+            if export_result and paginator.mode == 'stream':
+                export_result.stream()
+
+        retry_policy = self.retry_policy
+        if 'retry' in command:
+            retry_policy = self.retry_policy.override(command.pop('retry'))
+
+        latency_check = self.latency_check
+        if 'check_latency' in command:
+            latency_check = LatencyCheck(command.pop('check_latency'))
+
         if len(command.keys()) != 1:
             raise ValueError("You must provide one and only one endpoint per command, see the manual.\n{}".format(
                 "\n".join(['- {}'.format(k) for k in command])))
 
         # build the endpoint request
         key = command.keys()[0]
+        method = get_method(service, key)
 
         if hooks and "setup" in hooks:
             self.run_hook(hooks.get("setup"), "setup")
 
         repeat_bool = True
         times = 0
+        body_template = None
+        latencies = []
+        slow = False
 
         while repeat_bool:
-            # put the () for the endpoints
-            endpoint = 'service.' + key.replace('.', '().')
-            endpoint += '('
-
-            endpoint_args = []
+            expressions_time = time.time()
+            endpoint_args = {}
             if isinstance(command[key], dict):
                 for arg in command[key]:
                     val = command[key][arg]
@@ -369,20 +835,16 @@ class CommandParser():
                     # for body, read the json file
                     if arg == 'body':
                         # if we do not receive a json object, load it from a file
-                        if not isinstance(val, dict):
-                            match = self.expression_matcher.match(val)
-                            if match:
-                                # raises a ValueError, to be catched upper in the stack
-                                val = self.__parse_expression(match.group(1))
-                            else:
-                                body_file = self.get_filepath(self.scenario_root, val)
-
-                                if body_file:
-                                    with open(body_file, 'r') as body:
-                                        val = json.load(body)
+                        if isinstance(val, dict):
+                            if body_template is None:
+                                body_template = self.__body_template(val)
+                            template = body_template
+                        else:
+                            template = self.__body_template(val)
 
-                        # parse expressions in the body
-                        val = self._parse_body(val)
+                        # parse expressions in the body, the body can then be modified safely
+                        if template:
+                            val = template.render(self.__parse_expression, copy=True)
 
                         # avoid to use `self.eval_expr` in the yml by using `expr` directly
                         expr = lambda e: self.eval_expr('{{' + e + '}}')
@@ -405,16 +867,13 @@ class CommandParser():
                             body_to_print = val
                     else:
                         if isinstance(val, basestring):
-                            val = '"' + str(self.eval_expr(val)) + '"'
+                            val = self.eval_expr(val)
                         elif isinstance(val, list):
-                            # if we have a list here, we want to transform it into arg=[val1,val2]
-                            # resolving each element of the list
-                            val = ','.join([str(self.eval_expr(v)) for v in val])
-                            val = "[{}]".format(val)
+                            # resolve each element of the list
+                            val = [self.eval_expr(v) if isinstance(v, basestring) else v for v in val]
 
-                    endpoint_args.append("{} = {}".format(arg, val))
-
-            endpoint += ','.join(endpoint_args) + ').execute()'
+                    endpoint_args[arg] = val
+            self.__record_time(position, key, 'expressions', expressions_time)
 
             print "\n{}{}Executing : {}{}".format(ju.bold, ju.yellow, key, ju.end_color)
             if description:
@@ -423,54 +882,58 @@ class CommandParser():
             if body_to_print:
                 print ju.info_color
                 print "Body JSON:"
-                pretty_json(body_to_print)
+                pretty_json(body_to_print, limit=self.print_limit)
                 print ju.end_color
 
+            startup.profile.request_sent()
             exec_time = time.time()
             # run the endpoint request
             status = 200
             message = None
             result = None
 
-            retry = True
-            nb_retries = 5
-            while retry and nb_retries > 0:
-                nb_retries -= 1
+            # the repeated commands check the statuses themselves
+            retries = {}
+            try:
+                result = retry_policy.call(lambda: method(**endpoint_args).execute(),
+                                           lambda: describe_call(key, endpoint_args), stats=retries,
+                                           expected=check_code, statuses=not repeat)
+            except Exception as e:
                 try:
-                    ns = {'service': service}
-                    exec "result = {}".format(endpoint) in ns
-                    result = ns['result']
-                    retry = False
-                except BadStatusLine as e:
-                    print "RETRYING: {}".format(endpoint)
-                    retry = True
-                    time.sleep(1)
-                except Exception as e:
-                    retry = False
-                    try:
-                        message = json.loads(e.content).get('error').get('message')
-                    except:
-                        pass
-
-                    if check_code and hasattr(e, 'resp') and e.resp["status"] == str(check_code):
-                        status = check_code
-                    elif not repeat:
-                        if len(e.message) == 0:
-                            msg = e.__str__()
-                        else:
-                            msg = e.message
-                        print traceback.format_exc()
-                        raise RuntimeError("The executed command was: {}\nMessage: {}".
-                                           format(endpoint.replace("\.execute()", ""), msg))
+                    message = json.loads(e.content).get('error').get('message')
+                except:
+                    pass
+
+                if check_code and hasattr(e, 'resp') and e.resp["status"] == str(check_code):
+                    status = check_code
+                elif not repeat:
+                    if len(e.message) == 0:
+                        msg = e.__str__()
                     else:
-                        if hasattr(e, 'resp'):
-                            status = e.resp["status"]
-                        result = None
-            print "Done in {}ms".format(int(round((time.time() - exec_time) * 1000)))
+                        msg = e.message
+                    print traceback.format_exc()
+                    if retries['retries']:
+                        self.__add_time(position, key, 'retries', retries['seconds'], calls=retries['retries'])
+                    raise RuntimeError("The executed command was: {}\nMessage: {}".
+                                       format(describe_call(key, endpoint_args), msg))
+                else:
+                    if hasattr(e, 'resp'):
+                        status = e.resp["status"]
+                    result = None
+            elapsed = (time.time() - exec_time) * 1000
+            print "Done in {}ms".format(int(round(elapsed)))
+            self.notify_request(key, elapsed, status, check_code)
+            latencies.append(elapsed)
+            self.latency_total += elapsed
+            if latency_check and not latency_check.check_call(key, elapsed, exit_on_error=self.exit_on_error):
+                slow = True
+            self.__add_time(position, key, 'http', elapsed / 1000 - retries['seconds'])
+            if retries['retries']:
+                self.__add_time(position, key, 'retries', retries['seconds'], calls=retries['retries'])
 
             if not repeat and status != check_code:
                 raise RuntimeError("The executed command was: {}\nMessage: {}".format(
-                    endpoint.replace("\.execute()", ""),
+                    describe_call(key, endpoint_args),
                     "HTTP status code is {} and expected is {}.".format(status, check_code)
                 ))
             elif not repeat and int(check_code) - 200 >= 100:
@@ -478,131 +941,175 @@ class CommandParser():
 
             if check_message and check_message != message:
                 raise RuntimeError("The executed command was: {}\nMessage: {}".format(
-                    endpoint.replace("\.execute()", ""),
+                    describe_call(key, endpoint_args),
                     "HTTP error message is {} and expected is {}.".format(message, check_message)
                 ))
 
-            if eval_expr:
-                ns = {'saved_results': self.output_results,
-                      'result': result,
-                      'expr': lambda e, container=self.output_results: self.eval_expr('{{' + e + '}}', container)}
+            pages = [(result, True)]
+            if paginator and result:
+                pages = paginator.pages(
+                    result,
+                    lambda token: self.__fetch_page(lambda: service, key, endpoint_args, paginator.token, token,
+                                                    retry_policy),
+                    lambda token: pagination.prefetch(self.__fetch_page, new_service, key, endpoint_args,
+                                                      paginator.token, token, retry_policy) if new_service else None)
+                if paginator.mode == 'merge':
+                    pages = [(paginator.merge(pages), True)]
+
+            for page_idx, (result, last_page) in enumerate(pages):
+                if paginator and paginator.mode == 'stream':
+                    print "Page {}".format(page_idx + 1)
+                if eval_expr:
+                    eval_time = time.time()
+                    ns = {'saved_results': self.output_results,
+                          'result': result,
+                          'expr': lambda e, container=self.output_results: self.eval_expr('{{' + e + '}}', container)}
+
+                    if isinstance(eval_expr, str) or isinstance(eval_expr, unicode):
+                        exec eval_expr in ns
+                    elif isinstance(eval_expr, list):
+                        for e in eval_expr:
+                            exec e in ns
+
+                    result = ns.get('result', result)
+                    self.__record_time(position, key, 'eval_expr', eval_time)
+
+                if result_name and result:
+                    # only keep the selected parts of large results
+                    self.output_results[result_name] = project(result, keep) if keep else result
+
+                if export_result and result:
+                    # the pages are exported as the merged result, without their paging token
+                    export_result.write(paginator.strip(result) if paginator else result)
+
+                if result:
+                    self.__print_result(print_result, result)
+
+                # the repeat conditions apply to the last page
+                if repeat and last_page:
+                    repeat_bool = self.__parse_repeat(repeat, times, result, status, message)
+                    if repeat_bool:
+                        print "Calling the endpoint again"
+                    else:
+                        print "Done repeating the call"
+                    times += 1
+                elif not repeat:
+                    repeat_bool = False
+
+                if json_template and json_template.value:
+                    check_time = time.time()
+                    # only the expressions of the pattern are evaluated again
+                    json_pattern = json_template.render(self.__parse_expression)
+                    try:
+                        check_json(result, json_pattern, exit_on_error=self.exit_on_error)
+                    finally:
+                        report.reporter.flush()
+                        self.__record_time(position, key, 'check_result', check_time)
+
+                if order:
+                    order_time = time.time()
+                    if isinstance(order, str) or isinstance(order, unicode):
+                        match = self.expression_matcher.match(order)
+                        raise RuntimeError("Expression {} for check_order is incorrect".format(match.group(1)))
+
+                    elif isinstance(order, list):
+                        values = []
+                        directions = []
+                        paths = []
+                        for criteria in order:
+                            for expr, direction in criteria.iteritems():
+                                # we have a list!
+                                match = self.expression_matcher.match(expr)
+                                if match:
+                                    val = self.__parse_expression(match.group(1), container=result)
+                                    values.append(val)
+                                    directions.append(direction)
+                                    paths.append(match.group(1))
 
-                if isinstance(eval_expr, str) or isinstance(eval_expr, unicode):
-                    exec eval_expr in ns
-                elif isinstance(eval_expr, list):
-                    for e in eval_expr:
-                        exec e in ns
+                        try:
+                            check_order_values(values, directions, paths, exit_on_error=self.exit_on_error)
+                        finally:
+                            report.reporter.flush()
+                            self.__record_time(position, key, 'check_order', order_time)
+
+        if latency_check and not latency_check.check_calls(key, latencies, exit_on_error=self.exit_on_error):
+            slow = True
+        if self.baseline and not self.baseline.check(self.scenario.get('name', self.scenario_root),
+                                                     self.baseline_keys[position], latencies,
+                                                     threshold=self.baseline_threshold,
+                                                     exit_on_error=self.exit_on_error):
+            slow = True
 
-                result = ns.get('result', result)
+        if hooks and "teardown" in hooks:
+            self.run_hook(hooks.get("teardown"), "teardown")
 
-            if result_name and result:
-                self.output_results[result_name] = result
+        if slow:
+            raise AssertionError("{} is slower than expected".format(key))
 
-            if export_result and result:
-                with open("{}".format(export_result), 'w') as f:
-                    json.dump(result, f, indent=4, separators=(',', ': '))
+    def __print_result(self, print_result, result):
+        """
+        Print the result of a command, `print_result` is either True or one or several expressions
+        """
+        if print_result is True:
+            print ju.info_color
+            print "Result JSON:"
+            pretty_json(result, limit=self.print_limit)
+            print ju.end_color
+        elif isinstance(print_result, str) or isinstance(print_result, unicode):
+            # we have an expression!
+            match = self.expression_matcher.match(print_result)
+            if match:
+                val = None
+                try:
+                    val = self.__parse_expression(match.group(1), container=result)
+                except Exception as e:
+                    if self.debug:
+                        print traceback.format_exc()
+                    print e
 
-            if result:
-                if print_result is True:
+                if val:
                     print ju.info_color
-                    print "Result JSON:"
-                    pretty_json(result)
+                    print "Content of {}:".format(match.group(1))
+                    pretty_json(val, limit=self.print_limit)
                     print ju.end_color
-                elif isinstance(print_result, str) or isinstance(print_result, unicode):
-                    # we have an expression!
-                    match = self.expression_matcher.match(print_result)
-                    if match:
-                        val = None
-                        try:
-                            val = self.__parse_expression(match.group(1), container=result)
-                        except Exception as e:
-                            if self.debug:
-                                print traceback.format_exc()
-                            print e
-
-                        if val:
-                            print ju.info_color
-                            print "Content of {}:".format(match.group(1))
-                            pretty_json(val)
-                            print ju.end_color
-                elif isinstance(print_result, list):
-                    for expr in print_result:
-                        # we have an expression!
-                        match = self.expression_matcher.match(expr)
-                        if match:
-                            val = None
-                            try:
-                                val = self.__parse_expression(match.group(1), container=result)
-                            except Exception as e:
-                                if self.debug:
-                                    print traceback.format_exc()
-                                print e
-
-                            if val:
-                                print ju.info_color
-                                print "Content of {}:".format(match.group(1))
-                                pretty_json(val)
-                                print ju.end_color
-                            val = None
-
-            if repeat:
-                repeat_bool = self.__parse_repeat(repeat, times, result, status, message)
-                if repeat_bool:
-                    print "Calling the endpoint again"
-                else:
-                    print "Done repeating the call"
-                times += 1
-            else:
-                repeat_bool = False
-
-            if json_pattern:
-                json_pattern = self._parse_body(json_pattern)
-                check_json(result, json_pattern, exit_on_error=self.exit_on_error)
-
-            if order:
-                if isinstance(order, str) or isinstance(order, unicode):
-                    match = self.expression_matcher.match(order)
-                    raise RuntimeError("Expression {} for check_order is incorrect".format(match.group(1)))
-
-                elif isinstance(order, list):
-                    values = []
-                    directions = []
-                    paths = []
-                    for criteria in order:
-                        for expr, direction in criteria.iteritems():
-                            # we have a list!
-                            match = self.expression_matcher.match(expr)
-                            if match:
-                                val = self.__parse_expression(match.group(1), container=result)
-                                values.append(val)
-                                directions.append(direction)
-                                paths.append(match.group(1))
-
-                    check_order_values(values, directions, paths, exit_on_error=self.exit_on_error)
+        elif isinstance(print_result, list):
+            for expr in print_result:
+                # we have an expression!
+                match = self.expression_matcher.match(expr)
+                if match:
+                    val = None
+                    try:
+                        val = self.__parse_expression(match.group(1), container=result)
+                    except Exception as e:
+                        if self.debug:
+                            print traceback.format_exc()
+                        print e
+
+                    if val:
+                        print ju.info_color
+                        print "Content of {}:".format(match.group(1))
+                        pretty_json(val, limit=self.print_limit)
+                        print ju.end_color
+                    val = None
+
+    def __body_template(self, body):
+        """
+        The template of a body given as a json object, an expression or a json file name
+        """
+        if isinstance(body, dict):
+            return Template(body)
 
-        if hooks and "teardown" in hooks:
-            self.run_hook(hooks.get("teardown"), "teardown")
+        match = self.expression_matcher.match(body)
+        if match:
+            # raises a ValueError, to be catched upper in the stack
+            return Template(self.__parse_expression(match.group(1)))
+
+        body_file = self.get_filepath(self.scenario_root, body)
+        if body_file:
+            return load_template(body_file)
 
     def _parse_body(self, body):
-        body = dict(body)
-        for key, val in body.iteritems():
-            if isinstance(val, unicode) or isinstance(val, str):
-                match = self.expression_matcher.match(val)
-                if match:
-                    val = self.__parse_expression(match.group(1))
-                    body[key] = val
-            elif isinstance(val, list):
-                for idx, sub_val in enumerate(val):
-                    if isinstance(sub_val, dict):
-                        body[key][idx] = self._parse_body(sub_val)
-                    elif isinstance(sub_val, unicode) or isinstance(sub_val, str):
-                        match = self.expression_matcher.match(sub_val)
-                        if match:
-                            sub_val = self.__parse_expression(match.group(1))
-                            body[key][idx] = sub_val
-            elif isinstance(val, dict):
-                body[key] = self._parse_body(val)
-        return body
+        return Template(body).render(self.__parse_expression, copy=True)
 
     def __parse_expression(self, expression, container=None):
         """
@@ -619,7 +1126,8 @@ class CommandParser():
             expression = expression.replace("as list", "").strip()
 
         try:
-            results = jsonpath(container, expression)
+            # only the first match is needed when not returning a list
+            results = jsonpath(container, expression, first=not as_list)
         except Exception, e:
             print e
             raise RuntimeError("Error when parsing the expression {}".format(expression))
@@ -639,6 +1147,9 @@ class CommandParser():
         repeat:
             mode: until|while|loop (default: while)
             delay: <float> (default: 1)
+            backoff: <float> (default: 1, the delay is multiplied by it after each call)
+            max_delay: <float> (default: no limit)
+            jitter: <float> (default: 0, the random ratio of the delay removed from it)
             max: <int> (default: 5)
             conditions:
                 code: <int> (default: 200)
@@ -648,6 +1159,9 @@ class CommandParser():
         """
         mode = repeat.get('mode', 'while')
         delay = repeat.get('delay', 1.0)
+        backoff = repeat.get('backoff', 1.0)
+        max_delay = repeat.get('max_delay')
+        jitter = repeat.get('jitter', 0.)
         maximum = repeat.get('max', 5)
         conditions = repeat.get('conditions', {'code': 200, 'message': None, 'expression': None})
         has_code = conditions.get('code') is not None
@@ -711,7 +1225,7 @@ class CommandParser():
         if not cont:
             return False
 
-        time.sleep(delay)
+        time.sleep(backoff_delay(delay, times, backoff, max_delay, jitter))
         return True
 
     def eval_expr(self, val, container=None):
@@ -723,4 +1237,9 @@ class CommandParser():
 
     def run_hook(self, command, kind='setup'):
         print "Running {} hook {}".format(command, kind)
-        subprocess.call("./{}".format(command), shell=True)
+        # go through sys.stdout so that the hook output stays with the scenario one
+        process = subprocess.Popen("./{}".format(command), shell=True,
+                                   stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output, _ = process.communicate()
+        if output:
+            sys.stdout.write(output)
@@ -0,0 +1,187 @@
+import os
+import re
+import json
+import time
+import hashlib
+import keyword
+import threading
+
+import utils as ju
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'lumrest', 'discovery')
+DEFAULT_TTL = 24 * 3600
+# the names the api client adds a `_` to, like it does for the python keywords
+RESERVED_WORDS = frozenset(keyword.kwlist + ['body'])
+
+settings = {
+    'cache_dir': DEFAULT_CACHE_DIR,
+    'ttl': DEFAULT_TTL,
+    'offline': False,
+}
+
+# (api, version, discovery_url) -> (fetch time, document)
+_documents = {}
+_lock = threading.Lock()
+
+
+def configure(cache_dir=None, ttl=None, offline=None):
+    """
+    Change the discovery cache settings
+
+    `cache_dir` can be set to False to disable the on-disk cache, `ttl` is
+    given in seconds (0 for no expiration) and in `offline` mode the documents
+    are only read from the cache, whatever their age.
+    """
+    if cache_dir is not None:
+        settings['cache_dir'] = cache_dir
+    if ttl is not None:
+        settings['ttl'] = ttl
+    if offline is not None:
+        settings['offline'] = offline
+
+
+def _is_fresh(fetched_at):
+    return settings['offline'] or not settings['ttl'] or time.time() - fetched_at < settings['ttl']
+
+
+def _cache_path(key):
+    if not settings['cache_dir']:
+        return None
+    return os.path.join(settings['cache_dir'], hashlib.sha1(json.dumps(key)).hexdigest() + '.json')
+
+
+def _read_cache(key):
+    path = _cache_path(key)
+    if not path or not os.path.isfile(path):
+        return None, None
+
+    with open(path, 'r') as f:
+        return os.path.getmtime(path), f.read()
+
+
+def _write_cache(key, document):
+    path = _cache_path(key)
+    if not path:
+        return
+
+    if not os.path.isdir(settings['cache_dir']):
+        os.makedirs(settings['cache_dir'])
+
+    # write then rename, several processes can share the cache
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        f.write(document)
+    os.rename(tmp_path, path)
+
+
+def _fetch(api, version, discovery_url):
+    from apiclient.discovery import DISCOVERY_URI
+    from apiclient.errors import HttpError
+    from app import cassette
+
+    url = (discovery_url or DISCOVERY_URI).replace('{api}', api).replace('{apiVersion}', version)
+    # the documents are shared by the scenarios
+    resp, content = cassette.new_http(scoped=False).request(url)
+    if resp.status >= 400:
+        raise HttpError(resp, content, uri=url)
+
+    # fail early on an invalid document rather than caching it
+    json.loads(content)
+    return content
+
+
+def get_document(api, version, discovery_url=None):
+    """
+    Return the discovery document of an API
+
+    The documents are kept in memory for the whole run, and on disk under the
+    cache directory until their TTL is reached.
+    """
+    key = (api, version, discovery_url)
+
+    with _lock:
+        if key in _documents and _is_fresh(_documents[key][0]):
+            return _documents[key][1]
+
+        fetched_at, document = _read_cache(key)
+        if document is None or not _is_fresh(fetched_at):
+            if settings['offline']:
+                raise RuntimeError("The discovery document of {} {} is not cached, it cannot be fetched "
+                                   "in offline mode".format(api, version))
+            try:
+                document = _fetch(api, version, discovery_url)
+                fetched_at = time.time()
+                _write_cache(key, document)
+            except Exception as e:
+                if document is None:
+                    raise
+                print "{}Unable to refresh the discovery document of {} {}, using the cached one: {}{}".format(
+                    ju.warning_color, api, version, e, ju.end_color)
+                # do not try again for this run
+                fetched_at = time.time()
+
+        _documents[key] = (fetched_at, document)
+        return document
+
+
+def get_cached_document(api, version, discovery_url=None):
+    """
+    Return the discovery document of an API if it is cached, whatever its age, else None
+
+    The document is never fetched.
+    """
+    key = (api, version, discovery_url)
+    with _lock:
+        if key in _documents:
+            return _documents[key][1]
+    return _read_cache(key)[1]
+
+
+def _python_name(name, param=False):
+    # the api client turns the names into python identifiers
+    if param:
+        name = ('' if name[:1].isalpha() else 'x') + re.sub(r'[^a-zA-Z0-9]', '_', name)
+    return name + '_' if name in RESERVED_WORDS else name
+
+
+def find_method(document, key):
+    """
+    Return the description of the method of an endpoint key like `resource.sub_resource.method`, None if unknown
+    """
+    path = key.split('.')
+    node = document
+    for name in path[:-1]:
+        resources = dict((_python_name(k), v) for k, v in node.get('resources', {}).iteritems())
+        if name not in resources:
+            return None
+        node = resources[name]
+    methods = dict((_python_name(k), v) for k, v in node.get('methods', {}).iteritems())
+    return methods.get(path[-1])
+
+
+def iter_methods(document, node=None, prefix=''):
+    """
+    Yield the endpoint key and the description of each method of a discovery document
+    """
+    node = document if node is None else node
+    for name, method in sorted(node.get('methods', {}).iteritems()):
+        yield prefix + _python_name(name), method
+    for name, resource in sorted(node.get('resources', {}).iteritems()):
+        for key, method in iter_methods(document, resource, prefix + _python_name(name) + '.'):
+            yield key, method
+
+
+def method_arguments(document, method):
+    """
+    Return the arguments a method accepts and the required ones, as python names
+    """
+    parameters = dict(document.get('parameters', {}))
+    parameters.update(method.get('parameters', {}))
+
+    accepted = set(_python_name(name, param=True) for name in parameters)
+    required = set(_python_name(name, param=True) for name, param in parameters.iteritems() if param.get('required'))
+    if 'request' in method:
+        accepted.add('body')
+    if method.get('supportsMediaUpload'):
+        accepted.update(['media_body', 'media_mime_type'])
+    return accepted, required
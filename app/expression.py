@@ -1,4 +1,4 @@
-import yaml, json
+import json
 
 def expr_constructor(loader, node):
     """
@@ -0,0 +1,258 @@
+import os
+import re
+import copy
+import hashlib
+import threading
+import cPickle as pickle
+
+from expression import expr_constructor, json_constructor
+import startup
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'lumrest', 'scenarios')
+# changed when the parsed scenarios change for the same yaml
+CACHE_VERSION = 1
+
+settings = {
+    'cache_dir': DEFAULT_CACHE_DIR,
+}
+
+# the yaml loader, set up when a file is parsed for the first time as importing yaml is slow
+_loader = None
+# the version of yaml and the name of its loader, part of the cache keys
+_yaml_key = None
+re_yaml_version = re.compile(r"""^__version__\s*=\s*['"]([^'"]+)['"]""", re.MULTILINE)
+
+# the folders of the yaml files found so far, in the order they were found
+_search_paths = []
+_search_paths_set = set()
+# (scene root, path) -> (resolved path, number of search paths when it was not found)
+_resolved = {}
+# (loader, path) -> ((mtime, size), value)
+_contents = {}
+_lock = threading.Lock()
+
+
+def configure(cache_dir=None):
+    """
+    Change the folder where the parsed scenarios are kept, False to disable the on-disk cache
+    """
+    if cache_dir is not None:
+        settings['cache_dir'] = cache_dir
+
+
+def _get_loader():
+    """
+    The libyaml loader when available, else the loader used by default by yaml.load
+    """
+    global _loader
+    if _loader is None:
+        with startup.profile.step('import yaml'):
+            import yaml
+
+        if hasattr(yaml, 'FullLoader'):
+            loader = getattr(yaml, 'CFullLoader', yaml.FullLoader)
+        else:
+            loader = getattr(yaml, 'CLoader', yaml.Loader)
+
+        for tag, constructor in (('!expr', expr_constructor), ('!json', json_constructor)):
+            yaml.add_constructor(tag, constructor)
+            yaml.add_constructor(tag, constructor, Loader=loader)
+        _loader = loader
+    return _loader
+
+
+def _get_yaml_key():
+    """
+    The version of yaml and the name of the loader picked by `_get_loader`
+
+    They are found from the files of the yaml package, so that the cached
+    files are read without importing yaml.
+    """
+    global _yaml_key
+    if _yaml_key is None:
+        import imp
+        try:
+            folder = imp.find_module('yaml')[1]
+            with open(os.path.join(folder, '__init__.py'), 'r') as f:
+                match = re_yaml_version.search(f.read())
+        except (ImportError, IOError):
+            folder, match = None, None
+        version = match.group(1) if match else 'unknown'
+
+        # the libyaml bindings are in the package since yaml 5.4, a module of their own before
+        libyaml = folder is not None and any(name.startswith('_yaml.') and name.endswith(('.so', '.pyd'))
+                                             for name in os.listdir(folder))
+        if not libyaml:
+            try:
+                libyaml = imp.find_module('_yaml')[2][2] == imp.C_EXTENSION
+            except ImportError:
+                pass
+
+        # FullLoader was added by yaml 5.1
+        try:
+            full = tuple(int(part) for part in version.split('.')[:2]) >= (5, 1)
+        except ValueError:
+            full = False
+        _yaml_key = '{}:{}{}'.format(version, 'C' if libyaml else '', 'FullLoader' if full else 'Loader')
+    return _yaml_key
+
+
+def _cache_path(content):
+    if not settings['cache_dir']:
+        return None
+    key = hashlib.sha1('{}:{}:'.format(CACHE_VERSION, _get_yaml_key()) + content)
+    return os.path.join(settings['cache_dir'], key.hexdigest() + '.pickle')
+
+
+def parse_yaml(content):
+    """
+    Parse a yaml scenario
+
+    The result is kept on disk by the hash of the content, so that a file is
+    parsed again only when it changes.
+    """
+    path = _cache_path(content)
+    if path and os.path.isfile(path):
+        try:
+            with startup.profile.step('read cached yaml'):
+                with open(path, 'rb') as f:
+                    return pickle.load(f)
+        except Exception:
+            # a broken cache entry is written again
+            pass
+
+    loader = _get_loader()
+    import yaml
+    with startup.profile.step('parse yaml'):
+        value = yaml.load(content, Loader=loader)
+
+    if path:
+        try:
+            if not os.path.isdir(settings['cache_dir']):
+                os.makedirs(settings['cache_dir'])
+            # write then rename, several processes can share the cache
+            tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_path, path)
+        except (OSError, IOError, pickle.PicklingError):
+            pass
+    return value
+
+
+def search_paths():
+    """
+    The folders where the files are looked for after the scenario ones
+    """
+    return list(_search_paths)
+
+
+def _add_search_path(folder):
+    with _lock:
+        if folder not in _search_paths_set:
+            _search_paths_set.add(folder)
+            _search_paths.append(folder)
+
+
+def _candidates(scene_root, path):
+    paths = [re.sub(r'^\./', scene_root, path), os.path.abspath(path), os.path.abspath(os.path.join(scene_root, path))]
+    paths.extend([os.path.abspath(os.path.join(folder, path)) for folder in list(_search_paths)])
+    return paths
+
+
+def find_file(scene_root, path, strict=True):
+    """
+    Look for a file relatively to the scenario folder then to the folders of
+    the yaml files found before, returns its path
+
+    The result is kept until the file disappears, a file that cannot be found
+    is looked for again only once new folders are known.
+    """
+    key = (scene_root, path)
+    cached = _resolved.get(key)
+    if cached:
+        found, nb_search_paths = cached
+        if found and os.path.isfile(found):
+            return found
+        if not found and nb_search_paths == len(_search_paths) and not strict:
+            return None
+
+    nb_search_paths = len(_search_paths)
+    paths = _candidates(scene_root, path)
+    for candidate in paths:
+        if os.path.isfile(candidate):
+            # we don't keep track of the file where the command is kept
+            # thus we need an hack to keep track of the found files which could reference it
+            # !!! the resulting path could be ambiguous
+            _, ext = os.path.splitext(candidate)
+            if ext == '.yaml':
+                _add_search_path(os.path.dirname(candidate))
+            _resolved[key] = (candidate, None)
+            return candidate
+
+    _resolved[key] = (None, nb_search_paths)
+    if strict:
+        raise RuntimeError("{} cannot be found in any of the hintpaths ({})".format(path, paths))
+
+
+def load(path, loader):
+    """
+    Return `loader(path)`, it is called again only when the file changes
+
+    The files are told apart by their modification time and size, only the
+    last version of a file is kept.
+    """
+    stat = os.stat(path)
+    version = (stat.st_mtime, stat.st_size)
+    key = (loader, path)
+
+    with _lock:
+        cached = _contents.get(key)
+    if cached and cached[0] == version:
+        return cached[1]
+
+    value = loader(path)
+    with _lock:
+        _contents[key] = (version, value)
+    return value
+
+
+def _read(path):
+    with open(path, 'r') as f:
+        return f.read()
+
+
+def read_file(path):
+    """
+    Return the content of a file
+    """
+    return load(path, _read)
+
+
+def _load_yaml(path):
+    return parse_yaml(_read(path))
+
+
+def _load_include(path):
+    # the bodies referenced relatively to the included file
+    content = re.sub(r'(\s+body:\s*)\.\/(.*json)',
+                     r'\1{}/\2'.format(os.path.split(os.path.abspath(path))[0]), _read(path))
+    return parse_yaml(content)
+
+
+def load_scenario(path):
+    """
+    Return the scenario of a file, it is not kept in memory as it is modified when it is run
+    """
+    return parse_yaml(_read(path))
+
+
+def load_include(path, relative_bodies=True):
+    """
+    Return the scenario of a setup, import or teardown file
+
+    With `relative_bodies`, the `./` body files are looked for in the folder
+    of the included file. The commands are modified when they are run, a copy
+    is returned.
+    """
+    return copy.deepcopy(load(path, _load_include if relative_bodies else _load_yaml))
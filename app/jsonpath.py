@@ -41,7 +41,11 @@ __version__ = '0.54'
 #	OTHER DEALINGS IN THE SOFTWARE.
 
 import re
+import ast
 import sys
+import threading
+
+from collections import OrderedDict
 
 # XXX BUGS:
 # evalx is generally a crock:
@@ -53,11 +57,15 @@ import sys
 # internally keep paths as lists to preserve integer types
 #       (instead of as ';' delimited strings)
 
-__all__ = [ 'jsonpath' ]
+__all__ = [ 'jsonpath', 'compile_path', 'compile_filter', 'check_path' ]
 
-# XXX precompile RE objects on load???
-# re_1 = re.compile(.....)
-# re_2 = re.compile(.....)
+re_filters = re.compile(r"[\['](\??\(.*?\))[\]']")
+re_separators = re.compile(r"'?(?<!@)\.'?|\['?")
+re_descendants = re.compile(r";;;|;;")
+re_closing = re.compile(r";$|'?\]|'$")
+re_placeholders = re.compile(r"#([0-9]+)")
+re_slice = re.compile(r'(-?[0-9]*):(-?[0-9]*):?(-?[0-9]*)$')
+re_pieces = re.compile(r"'?,'?")
 
 def normalize(x):
     """normalize the path expression; outside jsonpath to allow testing"""
@@ -72,14 +80,14 @@ def normalize(x):
         ret = "[#%d]" % n
 #       print "f1:", g1, ret
         return ret
-    x = re.sub(r"[\['](\??\(.*?\))[\]']", f1, x)
+    x = re_filters.sub(f1, x)
 
     # added the negative lookbehind -krhodes
-    x = re.sub(r"'?(?<!@)\.'?|\['?", ";", x)
+    x = re_separators.sub(";", x)
 
-    x = re.sub(r";;;|;;", ";..;", x)
+    x = re_descendants.sub(";..;", x)
 
-    x = re.sub(r";$|'?\]|'$", "", x)
+    x = re_closing.sub("", x)
 
     # put expressions back
     def f2(m):
@@ -87,16 +95,183 @@ def normalize(x):
 #       print "f2:", g1
         return subx[int(g1)]
 
-    x = re.sub(r"#([0-9]+)", f2, x)
+    x = re_placeholders.sub(f2, x)
 
     return x
 
-def jsonpath(obj, expr, result_type='VALUE', debug=0, use_eval=True):
-    """traverse JSON object using jsonpath expr, returning values or paths"""
+class LRUCache(object):
+    """a small thread safe least recently used cache"""
+
+    def __init__(self, size=1024):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, compute):
+        """return the cached value of key, calling compute(key) if missing"""
+        with self.lock:
+            if key in self.entries:
+                value = self.entries.pop(key)
+                self.entries[key] = value
+                return value
+
+        value = compute(key)
+        with self.lock:
+            self.entries[key] = value
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        return value
+
+_compiled = LRUCache()
+
+def _compile(expr):
+    cleaned_expr = normalize(expr)
+    if cleaned_expr.startswith("$;"):
+        cleaned_expr = cleaned_expr[2:]
+    return tuple(cleaned_expr.split(';'))
+
+def compile_path(expr):
+    """turn a path expression into a tuple of steps, cached for later uses"""
+    return _compiled.get(expr, _compile)
+
+# the only names filter expressions can use
+FILTER_GLOBALS = {
+    '__builtins__': {},
+    'True': True, 'False': False, 'None': None,
+    'len': len, 'str': str, 'unicode': unicode, 'int': int, 'float': float, 'bool': bool,
+    'abs': abs, 'min': min, 'max': max, 'round': round, 'any': any, 'all': all,
+    're': re,
+}
+
+re_not_var = re.compile(r"!@\.([a-zA-Z@_]+)")
+re_var = re.compile(r'(?<!\\)(@\.[a-zA-Z@_.]+)')
+re_at = re.compile(r'(?<!\\)@')
+
+def translate_filter(loc):
+    """translate a filter or index expression into a python expression on __obj"""
+
+    # a nod to JavaScript. doesn't work for @.name.name.length
+    # Write len(@.name.name) instead!!!
+    loc = loc.replace("@.length", "len(__obj)")
+
+    loc = loc.replace("&&", " and ").replace("||", " or ")
+
+    # replace !@.name with 'name' not in obj
+    # XXX handle !@.name.name.name....
+    def notvar(m):
+        return "'%s' not in __obj" % m.group(1)
+    loc = re_not_var.sub(notvar, loc)
+
+    # replace @.name.... with __obj['name']....
+    # handle @.name[.name...].length
+    def varmatch(m):
+        def brackets(elts):
+            ret = "__obj"
+            for e in elts:
+                if e.isdigit():
+                    ret += "[%s]" % e # ain't necessarily so
+                else:
+                    ret += "['%s']" % e # XXX beware quotes!!!!
+            return ret
+        g1 = m.group(1)
+        elts = g1.split('.')
+        if elts[-1] == "length":
+            return "len(%s)" % brackets(elts[1:-1])
+        return brackets(elts[1:])
+
+    loc = re_var.sub(varmatch, loc)
+
+    # removed = -> == translation
+    # causes problems if a string contains =
+
+    # replace @  w/ "__obj", but \@ means a literal @
+    return re_at.sub("__obj", loc).replace(r'\@', '@')
+
+def _check_filter(tree, loc):
+    """refuse expressions reaching anything else than the object and FILTER_GLOBALS"""
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and node.id != '__obj' and node.id not in FILTER_GLOBALS:
+            raise ValueError("Name %s is not allowed in the filter %s" % (node.id, loc))
+        if isinstance(node, ast.Attribute) and node.attr.startswith('_'):
+            raise ValueError("Attribute %s is not allowed in the filter %s" % (node.attr, loc))
+        if isinstance(node, (ast.Lambda, ast.GeneratorExp, ast.ListComp, ast.DictComp, ast.SetComp, ast.Yield)):
+            raise ValueError("Filter %s is too complex" % loc)
+
+def _compile_filter(loc):
+    code = translate_filter(loc)
+    try:
+        tree = ast.parse(code.strip(), mode='eval')
+    except SyntaxError:
+        # invalid filters never match
+        return lambda obj: False
+    _check_filter(tree, loc)
+    return eval("lambda __obj: (%s)" % code.strip(), FILTER_GLOBALS)
+
+_filters = LRUCache()
+
+def compile_filter(loc):
+    """turn a filter or index expression into a predicate, cached for later uses"""
+    return _filters.get(loc, _compile_filter)
+
+def check_path(expr):
+    """raise a ValueError if the path expression cannot be used, without evaluating it"""
+    if not expr or not expr.strip():
+        raise ValueError("The expression is empty")
+
+    depth = {'[': 0, '(': 0}
+    closing = {']': '[', ')': '('}
+    quote = None
+    for c in expr:
+        if quote:
+            if c == quote:
+                quote = None
+        elif c in ('"', "'"):
+            quote = c
+        elif c in depth:
+            depth[c] += 1
+        elif c in closing:
+            depth[closing[c]] -= 1
+            if depth[closing[c]] < 0:
+                raise ValueError("Unbalanced %s in the expression %s" % (c, expr))
+    if quote:
+        raise ValueError("Unclosed quote in the expression %s" % expr)
+    for c, count in depth.iteritems():
+        if count:
+            raise ValueError("Unbalanced %s in the expression %s" % (c, expr))
+
+    for loc in compile_path(expr):
+        if not loc:
+            raise ValueError("Empty step in the expression %s" % expr)
+        if loc.startswith("?(") and loc.endswith(")"):
+            loc = loc[2:-1]
+        elif not (loc.startswith("(") and loc.endswith(")")):
+            continue
+
+        code = translate_filter(loc)
+        try:
+            tree = ast.parse(code.strip(), mode='eval')
+        except SyntaxError:
+            raise ValueError("Invalid filter %s in the expression %s" % (loc, expr))
+        _check_filter(tree, loc)
+
+def jsonpath(obj, expr, result_type='VALUE', debug=0, use_eval=True, first=False):
+    """traverse JSON object using jsonpath expr, returning values or paths
+
+    the traversal uses an explicit stack rather than recursion, paths are
+    only tracked when they are returned, and with first=True it stops at the
+    first match (returned in a one element list)"""
 
     def s(x,y):
-        """concatenate path elements"""
-        return str(x) + ';' + str(y)
+        """concatenate path elements, when paths are tracked"""
+        if x is None:
+            return None
+        return '%s;%s' % (x, y)
+
+    def step(key, steps):
+        """prepend a key to a tuple of steps"""
+        if not isinstance(key, basestring):
+            key = str(key)
+        return (key,) + steps
 
     def isint(x):
         """check if argument represents a decimal integer"""
@@ -125,166 +300,149 @@ def jsonpath(obj, expr, result_type='VALUE', debug=0, use_eval=True):
             result.append(as_path(path))
         return path
 
+    def keys(obj):
+        """the keys walked by wildcards, filters and descendants"""
+        if isinstance(obj, list):
+            return xrange(0, len(obj))
+        elif isinstance(obj, dict):
+            return list(obj)
+        return ()
+
+    def children(x, obj, path):
+        """tasks applying the steps x to each child of obj"""
+        if path is None:
+            for key in keys(obj):
+                yield (x, obj[key], None, None)
+        else:
+            for key in keys(obj):
+                yield (x, obj[key], s(path, key), None)
+
+    def filtered_children(x, obj, path, condition):
+        """tasks applying the steps x to each child of obj matching condition"""
+        for key in keys(obj):
+            yield (x, obj[key], s(path, key), (condition, obj[key]))
+
+    def siblings(x, obj, path, locs):
+        """tasks applying the steps x prefixed by each of locs to obj"""
+        for loc in locs:
+            yield (step(loc, x), obj, path, None)
+
     def trace(expr, obj, path):
-        if debug: print "trace", expr, "/", path
-        if expr:
-            x = expr.split(';')
-            loc = x[0]
-            x = ';'.join(x[1:])
+        """depth first traversal, results are stored in document order"""
+        # the stack holds iterators over tasks, generated lazily so that we
+        # can stop early. Each task is (steps, obj, path, filter), filter
+        # being None or a (filter_expression, item) pair evaluated when the
+        # task is reached
+        stack = []
+        # a task to handle right away, before the stacked ones
+        pending = (expr, obj, path, None)
+        while pending or stack:
+            if pending:
+                expr, obj, path, condition = pending
+                pending = None
+            else:
+                try:
+                    expr, obj, path, condition = next(stack[-1])
+                except StopIteration:
+                    stack.pop()
+                    continue
+
+            if condition is not None and not evalx(*condition):
+                continue
+
+            if debug: print "trace", expr, "/", path
+            if not expr:
+                store(path, obj)
+                if first:
+                    return True
+                continue
+
+            if not isinstance(obj, (dict, list)):
+                # no step can go further than a scalar
+                continue
+
+            loc = expr[0]
+            x = expr[1:]
+            tasks = None
             if debug: print "\t", loc, type(obj)
             if loc == "*":
-                def f03(key, loc, expr, obj, path):
-                    if debug > 1: print "\tf03", key, loc, expr, path
-                    trace(s(key, expr), obj, path)
-                walk(loc, x, obj, path, f03)
+                if not x:
+                    # the children are results, no need to stack them
+                    for key in keys(obj):
+                        store(s(path, key), obj[key])
+                        if first:
+                            return True
+                    continue
+                tasks = children(x, obj, path)
             elif loc == "..":
-                trace(x, obj, path)
-                def f04(key, loc, expr, obj, path):
-                    if debug > 1: print "\tf04", key, loc, expr, path
-                    if isinstance(obj, dict):
-                        if key in obj:
-                            trace(s('..', expr), obj[key], s(path, key))
-                    else:
-                        if key < len(obj):
-                            trace(s('..', expr), obj[key], s(path, key))
-                walk(loc, x, obj, path, f04)
+                # expr is ('..',) + x
+                stack.append(children(expr, obj, path))
+                pending = (x, obj, path, None)
             elif loc == "!":
                 # Perl jsonpath extension: return keys
-                def f06(key, loc, expr, obj, path):
-                    if isinstance(obj, dict):
-                        trace(expr, key, path)
-                walk(loc, x, obj, path, f06)
+                if isinstance(obj, dict):
+                    tasks = [(x, key, path, None) for key in obj]
             elif isinstance(obj, dict) and loc in obj:
-                trace(x, obj[loc], s(path, loc))
+                pending = (x, obj[loc], s(path, loc), None)
             elif isinstance(obj, list) and isint(loc):
                 iloc = int(loc)
                 if len(obj) >= iloc:
-                    trace(x, obj[iloc], s(path, loc))
-            else:
-                # [(index_expression)]
-                if loc.startswith("(") and loc.endswith(")"):
-                    if debug > 1: print "index", loc
-                    e = evalx(loc, obj)
-                    trace(s(e,x), obj, path)
-                    return
-
-                # ?(filter_expression)
-                if loc.startswith("?(") and loc.endswith(")"):
-                    if debug > 1: print "filter", loc
-                    def f05(key, loc, expr, obj, path):
-                        if debug > 1: print "f05", key, loc, expr, path
-                        if isinstance(obj, dict):
-                            eval_result = evalx(loc, obj[key])
-                        else:
-                            eval_result = evalx(loc, obj[int(key)])
-                        if eval_result:
-                            trace(s(key, expr), obj, path)
-
-                    loc = loc[2:-1]
-                    walk(loc, x, obj, path, f05)
-                    return
-
-                m = re.match(r'(-?[0-9]*):(-?[0-9]*):?(-?[0-9]*)$', loc)
-                if m:
-                    if isinstance(obj, (dict, list)):
-                        def max(x,y):
-                            if x > y:
-                                return x
-                            return y
-
-                        def min(x,y):
-                            if x < y:
-                                return x
-                            return y
-
-                        objlen = len(obj)
-                        s0 = m.group(1)
-                        s1 = m.group(2)
-                        s2 = m.group(3)
-
-                        # XXX int("badstr") raises exception
-                        start = int(s0) if s0 else 0
-                        end = int(s1) if s1 else objlen
-                        step = int(s2) if s2 else 1
-
-                        if start < 0:
-                            start = max(0, start+objlen)
-                        else:
-                            start = min(objlen, start)
-                        if end < 0:
-                            end = max(0, end+objlen)
-                        else:
-                            end = min(objlen, end)
-
-                        for i in xrange(start, end, step):
-                            trace(s(i, x), obj, path)
-                    return
-
-                # after (expr) & ?(expr)
-                if loc.find(",") >= 0:
-                    # [index,index....]
-                    for piece in re.split(r"'?,'?", loc):
-                        if debug > 1: print "piece", piece
-                        trace(s(piece, x), obj, path)
-        else:
-            store(path, obj)
-
-    def walk(loc, expr, obj, path, funct):
-        if isinstance(obj, list):
-            for i in xrange(0, len(obj)):
-                funct(i, loc, expr, obj, path)
-        elif isinstance(obj, dict):
-            for key in obj:
-                funct(key, loc, expr, obj, path)
+                    pending = (x, obj[iloc], s(path, loc), None)
+
+            # [(index_expression)]
+            elif loc.startswith("(") and loc.endswith(")"):
+                if debug > 1: print "index", loc
+                e = evalx(loc, obj)
+                pending = (step(e, x), obj, path, None)
+
+            # ?(filter_expression)
+            elif loc.startswith("?(") and loc.endswith(")"):
+                if debug > 1: print "filter", loc
+                loc = loc[2:-1]
+                tasks = filtered_children(x, obj, path, loc)
+
+            elif re_slice.match(loc):
+                m = re_slice.match(loc)
+                objlen = len(obj)
+                s0 = m.group(1)
+                s1 = m.group(2)
+                s2 = m.group(3)
+
+                # XXX int("badstr") raises exception
+                start = int(s0) if s0 else 0
+                end = int(s1) if s1 else objlen
+                step_ = int(s2) if s2 else 1
+
+                if start < 0:
+                    start = max(0, start+objlen)
+                else:
+                    start = min(objlen, start)
+                if end < 0:
+                    end = max(0, end+objlen)
+                else:
+                    end = min(objlen, end)
+
+                tasks = siblings(x, obj, path, xrange(start, end, step_))
+
+            # after (expr) & ?(expr)
+            elif loc.find(",") >= 0:
+                # [index,index....]
+                tasks = siblings(x, obj, path, re_pieces.split(loc))
+
+            if tasks is not None:
+                stack.append(iter(tasks))
 
     def evalx(loc, obj):
         """eval expression"""
 
         if debug: print "evalx", loc
-
-        # a nod to JavaScript. doesn't work for @.name.name.length
-        # Write len(@.name.name) instead!!!
-        loc = loc.replace("@.length", "len(__obj)")
-
-        loc = loc.replace("&&", " and ").replace("||", " or ")
-
-        # replace !@.name with 'name' not in obj
-        # XXX handle !@.name.name.name....
-        def notvar(m):
-            return "'%s' not in __obj" % m.group(1)
-        loc = re.sub("!@\.([a-zA-Z@_]+)", notvar, loc)
-
-        # replace @.name.... with __obj['name']....
-        # handle @.name[.name...].length
-        def varmatch(m):
-            def brackets(elts):
-                ret = "__obj"
-                for e in elts:
-                    if isint(e):
-                        ret += "[%s]" % e # ain't necessarily so
-                    else:
-                        ret += "['%s']" % e # XXX beware quotes!!!!
-                return ret
-            g1 = m.group(1)
-            elts = g1.split('.')
-            if elts[-1] == "length":
-                return "len(%s)" % brackets(elts[1:-1])
-            return brackets(elts[1:])
-
-        loc = re.sub(r'(?<!\\)(@\.[a-zA-Z@_.]+)', varmatch, loc)
-
-        # removed = -> == translation
-        # causes problems if a string contains =
-
-        # replace @  w/ "__obj", but \@ means a literal @
-        loc = re.sub(r'(?<!\\)@', "__obj", loc).replace(r'\@', '@')
         if not use_eval:
             if debug: print "eval disabled"
             raise Exception("eval disabled")
-        if debug: print "eval", loc
+
+        predicate = compile_filter(loc)
         try:
-            # eval w/ caller globals, w/ local "__obj"!
-            v = eval(loc, caller_globals, {'__obj': obj})
+            v = predicate(obj)
         except Exception, e:
             if debug: print e
             return False
@@ -294,16 +452,10 @@ def jsonpath(obj, expr, result_type='VALUE', debug=0, use_eval=True):
 
     # body of jsonpath()
 
-    # Get caller globals so eval can pick up user functions!!!
-    caller_globals = sys._getframe(1).f_globals
     result = []
     if expr and obj:
-        cleaned_expr = normalize(expr)
-        if cleaned_expr.startswith("$;"):
-            cleaned_expr = cleaned_expr[2:]
-
         # XXX wrap this in a try??
-        trace(cleaned_expr, obj, '$')
+        trace(compile_path(expr), obj, '$' if result_type != 'VALUE' else None)
 
         if len(result) > 0:
             return result
@@ -315,8 +467,6 @@ if __name__ == '__main__':
     except ImportError:
         import simplejson as json
 
-    import sys
-
     # XXX take options for output format, output file, debug level
 
     if len(sys.argv) < 3 or len(sys.argv) > 4:
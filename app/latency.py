@@ -0,0 +1,156 @@
+import os
+import json
+import math
+import threading
+
+from utils import light_assert
+
+# the percentiles a command can be checked against
+PERCENTILES = {'p50': .5, 'p90': .9, 'p99': .99}
+
+settings = {
+    'update_baseline': False,
+}
+
+# path -> Baseline
+_baselines = {}
+_lock = threading.Lock()
+
+
+def configure(update_baseline=None):
+    """
+    Change the latency settings, with `update_baseline` the baselines are replaced by the latencies of the run
+    """
+    if update_baseline is not None:
+        settings['update_baseline'] = update_baseline
+
+
+def percentile(values, ratio):
+    """
+    The nearest rank percentile of sorted values
+    """
+    if not values:
+        return 0
+    rank = int(math.ceil(ratio * len(values))) - 1
+    return values[min(max(rank, 0), len(values) - 1)]
+
+
+class LatencyCheck(object):
+    """
+    The latency bounds of a command
+
+    The configuration is either a number of ms, the maximum duration of each
+    call, or a dict with `max_ms` and the `p50`, `p90` and `p99` bounds of
+    the calls of a repeated command.
+    """
+    def __init__(self, config):
+        if isinstance(config, (int, float)):
+            config = {'max_ms': config}
+        if not isinstance(config, dict):
+            raise ValueError("check_latency must be either a number of ms or a dict")
+
+        unknown = set(config) - set(PERCENTILES) - set(['max_ms'])
+        if unknown:
+            raise ValueError("Unknown check_latency keys: {}".format(", ".join(sorted(unknown))))
+
+        self.max_ms = config.get('max_ms')
+        self.bounds = dict((name, config[name]) for name in PERCENTILES if name in config)
+
+    def check_call(self, key, elapsed, exit_on_error=False):
+        """
+        Check the duration of a call, in ms
+        """
+        if self.max_ms is None:
+            return True
+        return light_assert(
+            elapsed <= self.max_ms,
+            u'The call to {} took {:.0f}ms, more than {}ms'.format(key, elapsed, self.max_ms),
+            exit_on_error=exit_on_error)
+
+    def check_calls(self, key, latencies, exit_on_error=False):
+        """
+        Check the percentiles of the durations of the calls of a command, in ms
+        """
+        values = sorted(latencies)
+        no_error = True
+        for name, bound in sorted(self.bounds.iteritems()):
+            value = percentile(values, PERCENTILES[name])
+            no_error = light_assert(
+                value <= bound,
+                u'The {} latency of {} is {:.0f}ms, more than {}ms ({} call(s))'.format(
+                    name, key, value, bound, len(values)),
+                exit_on_error=exit_on_error) and no_error
+        return no_error
+
+
+class Baseline(object):
+    """
+    The median latencies of the commands of previous runs, stored in a json file
+
+    The commands without baseline, or all of them when the baselines are
+    updated, are recorded in the file.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        # scenario -> command -> median latency
+        self.latencies = self.__load()
+        self.changes = {}
+
+    def __load(self):
+        if not os.path.isfile(self.path):
+            return {}
+        with open(self.path, 'r') as f:
+            return json.load(f)
+
+    def check(self, scenario, command, latencies, threshold=0.2, exit_on_error=False):
+        """
+        Compare the median latency of a command to its baseline, it is slower by more than `threshold` (a ratio)
+        """
+        median = percentile(sorted(latencies), .5)
+        with self.lock:
+            baseline = self.latencies.get(scenario, {}).get(command)
+            if baseline is None or settings['update_baseline']:
+                self.changes.setdefault(scenario, {})[command] = median
+
+        if baseline is None:
+            return True
+
+        return light_assert(
+            median <= baseline * (1 + threshold),
+            u'The median latency of {} is {:.0f}ms, {:.0f}% more than its baseline of {:.0f}ms'.format(
+                command, median, (median / baseline - 1) * 100 if baseline else 100, baseline),
+            exit_on_error=exit_on_error)
+
+    def save(self):
+        """
+        Write the new latencies, merged with the ones written by other runs meanwhile
+        """
+        with self.lock:
+            if not self.changes:
+                return
+
+            latencies = self.__load()
+            for scenario, commands in self.changes.iteritems():
+                latencies.setdefault(scenario, {}).update(commands)
+            self.latencies = latencies
+            self.changes = {}
+
+            folder = os.path.dirname(os.path.abspath(self.path))
+            if not os.path.isdir(folder):
+                os.makedirs(folder)
+            tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+            with open(tmp_path, 'w') as f:
+                json.dump(latencies, f, indent=4, separators=(',', ': '), sort_keys=True)
+            os.rename(tmp_path, self.path)
+
+
+def get_baseline(path):
+    """
+    Return the baseline stored in a file, shared by the scenarios using it
+    """
+    path = os.path.abspath(path)
+    with _lock:
+        if path not in _baselines:
+            _baselines[path] = Baseline(path)
+        return _baselines[path]
@@ -0,0 +1,173 @@
+import sys
+import copy
+import time
+import threading
+import traceback
+
+from app import default
+from app.concurrency import ThreadLocalOutput
+from app.latency import percentile
+import utils as ju
+
+
+class LatencyRecorder(object):
+    """
+    Record the duration of the requests of every virtual user, by endpoint key
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        # endpoint key -> durations in ms
+        self.durations = {}
+        self.errors = {}
+        self.iterations = 0
+        self.failed_iterations = 0
+
+    def record(self, key, elapsed, status, expected=200):
+        """
+        Record a request, the error statuses are errors unless the command expects them
+        """
+        with self.lock:
+            self.durations.setdefault(key, []).append(elapsed)
+            if status is None or (int(status) >= 400 and str(status) != str(expected)):
+                self.errors[key] = self.errors.get(key, 0) + 1
+
+    def iteration_done(self, error):
+        """
+        Count an iteration, returns True for the first failing one
+        """
+        with self.lock:
+            self.iterations += 1
+            if error:
+                self.failed_iterations += 1
+            return error and self.failed_iterations == 1
+
+    def report(self, elapsed):
+        """
+        Print the throughput and the latency percentiles of each endpoint key
+        """
+        with self.lock:
+            durations = dict((key, sorted(values)) for key, values in self.durations.iteritems())
+            errors = dict(self.errors)
+
+        total = sum(len(values) for values in durations.itervalues())
+        print "\n{}Load test: {} iteration(s), {} failed, {} request(s) in {:.1f}s, {:.1f} req/s{}".format(
+            ju.bold, self.iterations, self.failed_iterations, total, elapsed, total / elapsed if elapsed else 0,
+            ju.end_color)
+
+        print "{:<40} {:>8} {:>7} {:>8} {:>8} {:>8} {:>8} {:>8}".format(
+            "endpoint", "requests", "errors", "req/s", "p50(ms)", "p90(ms)", "p99(ms)", "max(ms)")
+        for key in sorted(durations):
+            values = durations[key]
+            print "{:<40} {:>8} {:>7} {:>8.1f} {:>8.0f} {:>8.0f} {:>8.0f} {:>8.0f}".format(
+                key, len(values), errors.get(key, 0), len(values) / elapsed if elapsed else 0,
+                percentile(values, .5), percentile(values, .9), percentile(values, .99), values[-1])
+
+        return sum(errors.itervalues()) > 0 or self.failed_iterations > 0
+
+
+class VirtualUser(threading.Thread):
+    """
+    Run the commands of a scenario in a loop, with its own saved results
+    """
+    def __init__(self, idx, scene, scenario_root, config, recorder, output, start_delay=0, iterations=None,
+                 deadline=None, stop=None, scenario_file=None):
+        threading.Thread.__init__(self, name='vu-{}'.format(idx))
+        self.daemon = True
+        self.scene = scene
+        self.scenario_root = scenario_root
+        self.scenario_file = scenario_file
+        self.config = config
+        self.recorder = recorder
+        self.output = output
+        self.start_delay = start_delay
+        self.iterations = iterations
+        self.deadline = deadline
+        self.stop = stop
+
+    def done(self, nb_iterations):
+        if self.stop.is_set():
+            return True
+        if self.deadline is not None and time.time() >= self.deadline:
+            return True
+        return self.iterations is not None and nb_iterations >= self.iterations
+
+    def run(self):
+        if self.start_delay:
+            self.stop.wait(self.start_delay)
+
+        nb_iterations = 0
+        while not self.done(nb_iterations):
+            # the output of the scenarios is dropped
+            self.output.capture()
+            try:
+                # the commands are modified when they are run
+                command_parser = default.CommandParser(self.config, copy.deepcopy(self.scene), self.scenario_root,
+                                                       scenario_file=self.scenario_file)
+                command_parser.request_listeners.append(self.recorder.record)
+                error = command_parser.parse()
+            except SystemExit:
+                # skipped scenario
+                self.output.release()
+                return
+            except Exception:
+                print traceback.format_exc()
+                error = True
+            output = self.output.release()
+
+            if self.recorder.iteration_done(error):
+                # show why the first iteration failed
+                self.output.stream.write(output)
+            nb_iterations += 1
+
+
+def run_load(scene, scenario_root, config, users=1, duration=None, iterations=None, ramp_up=0, scenario_file=None):
+    """
+    Run a scenario as a workload of `users` virtual users
+
+    Each virtual user runs the whole scenario in a loop, with its own saved
+    results and services, for `duration` seconds and/or `iterations` times
+    (once by default). The users are started evenly over `ramp_up`
+    seconds.
+
+    Return a boolean (True if a request or an iteration failed, else False)
+    """
+    if users < 1:
+        raise ValueError("At least one virtual user is needed")
+    if duration is None and iterations is None:
+        iterations = 1
+
+    recorder = LatencyRecorder()
+    stop = threading.Event()
+    stdout = sys.stdout
+    output = ThreadLocalOutput(stdout)
+
+    print "{}Running {} with {} virtual user(s), {}{}".format(
+        ju.bold, scene.get('name', scenario_root), users,
+        ", ".join(limit for limit in ["for {}s".format(duration) if duration is not None else None,
+                                       "{} iteration(s) each".format(iterations) if iterations else None] if limit),
+        ju.end_color)
+
+    start = time.time()
+    deadline = start + duration if duration is not None else None
+    vus = [VirtualUser(idx, scene, scenario_root, config, recorder, output,
+                       start_delay=float(ramp_up) * idx / users, iterations=iterations, deadline=deadline, stop=stop,
+                       scenario_file=scenario_file)
+           for idx in xrange(users)]
+
+    sys.stdout = output
+    try:
+        for vu in vus:
+            vu.start()
+        # a timeout keeps the main thread responsive to KeyboardInterrupt
+        for vu in vus:
+            while vu.is_alive():
+                vu.join(1)
+    except KeyboardInterrupt:
+        stop.set()
+        stdout.write("Interrupted, waiting for the running iterations\n")
+        for vu in vus:
+            vu.join()
+    finally:
+        sys.stdout = stdout
+
+    return recorder.report(time.time() - start)
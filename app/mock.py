@@ -0,0 +1,399 @@
+import os
+import re
+import json
+import time
+import random
+import hashlib
+import threading
+import urlparse
+
+from httplib import BadStatusLine
+
+from app import discovery
+from app import files
+from app.template import Template, load_template
+from jsonpath import jsonpath
+import utils as ju
+
+# the behaviour of every method, unless changed for the whole mock or for a method
+DEFAULTS = {
+    'status': 200,
+    'response': None,
+    'latency_ms': 0,
+    'jitter_ms': 0,
+    'errors': {},
+}
+ERROR_DEFAULTS = {
+    'rate': 0.,
+    'statuses': [429, 503],
+    'retry_after': None,
+    'drop': 0.,
+}
+
+settings = {
+    # the mock configuration when the requests are answered by the mock backend
+    'config': None,
+}
+
+# document hash -> MockBackend
+_backends = {}
+_lock = threading.Lock()
+
+
+def configure(config=None):
+    """
+    Answer the requests with the mock backend described by a configuration file
+    """
+    if config is not None:
+        settings['config'] = MockConfig.load(config) if config else None
+
+
+def _check_errors(where, errors):
+    if not isinstance(errors, dict):
+        raise ValueError("The errors of {} must be a dict".format(where))
+    unknown = set(errors) - set(ERROR_DEFAULTS)
+    if unknown:
+        raise ValueError("Unknown errors keys for {}: {}".format(where, ", ".join(sorted(unknown))))
+    statuses = errors.get('statuses', ERROR_DEFAULTS['statuses'])
+    if not isinstance(statuses, list) or not statuses:
+        raise ValueError("The error statuses of {} must be a list".format(where))
+    for key in ('rate', 'drop'):
+        if not 0 <= errors.get(key, 0) <= 1:
+            raise ValueError("The error {} of {} must be between 0 and 1".format(key, where))
+
+
+class MockConfig(object):
+    """
+    The discovery documents, canned responses, latencies and errors of the mock backend
+
+    The configuration is a dict with:
+
+    - `documents`: the discovery documents served by the mock, json files
+    - `seed`: the seed of the random latencies and errors, for reproducible runs
+    - `status`, `latency_ms`, `jitter_ms` and `errors`: the behaviour of all
+      the methods
+    - `methods`: the behaviour of some methods, by endpoint key or method id,
+      with the same keys and a `response`
+
+    `errors` is a dict with the `rate` of the calls answered by one of the
+    error `statuses` ([429, 503]), with a Retry-After header if `retry_after`
+    is set, and the `drop` rate of the calls whose connection is closed
+    without response.
+    """
+    def __init__(self, config=None, root='.'):
+        config = dict(config or {})
+        self.root = root
+        self.documents = {}
+        for path in config.pop('documents', []):
+            content = files.read_file(files.find_file(root, path))
+            document = json.loads(content)
+            self.documents[(document['name'], document['version'])] = content
+
+        self.random = random.Random(config.pop('seed', None))
+        self.lock = threading.Lock()
+
+        methods = config.pop('methods', {})
+        if not isinstance(methods, dict):
+            raise ValueError("The mock methods must be a dict")
+
+        self.defaults = self.__settings('the mock', DEFAULTS, config)
+        self.methods = dict((key, self.__settings(key, self.defaults, method or {}))
+                            for key, method in methods.iteritems())
+
+    def __settings(self, where, defaults, config):
+        unknown = set(config) - set(DEFAULTS)
+        if unknown:
+            raise ValueError("Unknown mock keys for {}: {}".format(where, ", ".join(sorted(unknown))))
+        _check_errors(where, config.get('errors', {}))
+
+        result = dict(defaults)
+        result.update(config)
+        result['errors'] = dict(ERROR_DEFAULTS, **defaults.get('errors', {}))
+        result['errors'].update(config.get('errors', {}))
+
+        response = result['response']
+        if isinstance(response, basestring):
+            result['response'] = load_template(files.find_file(self.root, response))
+        elif response is not None and not isinstance(response, Template):
+            result['response'] = Template(response)
+        return result
+
+    @classmethod
+    def load(cls, path):
+        config = files.parse_yaml(files.read_file(path))
+        return cls(config, os.path.dirname(os.path.abspath(path)))
+
+    def method(self, key, method_id):
+        """
+        The behaviour of a method
+        """
+        return self.methods.get(key) or self.methods.get(method_id) or self.defaults
+
+    def uniform(self, low, high):
+        with self.lock:
+            return self.random.uniform(low, high)
+
+    def choice(self, values):
+        with self.lock:
+            return self.random.choice(values)
+
+    def document(self, api, version):
+        """
+        The discovery document of an API given in the configuration, None if there is none
+        """
+        return self.documents.get((api, version))
+
+
+class MockBackend(object):
+    """
+    Answer the requests of the methods of discovery documents
+
+    The request urls are matched against the paths of the methods, the path
+    and query parameters and the json body are then available to the
+    `{{expression}}` of the canned responses. Without canned response, a
+    method answers with its request body, or an empty object.
+    """
+    def __init__(self, documents, config):
+        self.config = config
+        self.routes = []
+        self.batch_paths = set()
+        self.stats = {'calls': 0, 'errors': 0, 'drops': 0}
+        self.stats_lock = threading.Lock()
+
+        for document in documents:
+            if isinstance(document, basestring):
+                document = json.loads(document)
+            root = urlparse.urlsplit(document.get('rootUrl', '/')).path or '/'
+            self.batch_paths.add(root + document.get('batchPath', 'batch'))
+            for key, method in discovery.iter_methods(document):
+                names = []
+
+                def parameter(match):
+                    names.append(re.sub(r'\\(.)', r'\1', match.group(2)))
+                    return '(.+)' if match.group(1) else '([^/]+)'
+
+                path = re.sub(r'\\\{(\\\+)?([^}]+?)\\\}', parameter,
+                              re.escape(root + document.get('servicePath', '') + method['path']))
+                self.routes.append((method.get('httpMethod', 'GET'), re.compile('^' + path + '$'), names, key,
+                                    method))
+
+    def count(self, name):
+        with self.stats_lock:
+            self.stats[name] += 1
+
+    def route(self, http_method, path):
+        """
+        The endpoint key, the description and the path parameters of the method of a request, None if unknown
+        """
+        for route_method, regex, names, key, method in self.routes:
+            match = regex.match(path)
+            if match and route_method == http_method:
+                return key, method, dict(zip(names, [urlparse.unquote(value) for value in match.groups()]))
+        return None
+
+    def handle(self, method, uri, body=None, headers=None):
+        """
+        Answer a request, returns its status, headers and content
+
+        Raises a BadStatusLine error when the connection is dropped.
+        """
+        path = urlparse.urlsplit(uri).path
+        if method.upper() == 'POST' and path in self.batch_paths:
+            return self.batch(body, headers or {})
+        return self.answer(method, uri, body)
+
+    def answer(self, method, uri, body=None):
+        _, _, path, query, _ = urlparse.urlsplit(uri)
+        found = self.route(method.upper(), path)
+        if found is None:
+            return _error(404, "No method for {} {}".format(method.upper(), path))
+
+        key, description, params = found
+        behaviour = self.config.method(key, description.get('id'))
+        self.count('calls')
+
+        latency = behaviour['latency_ms'] + self.config.uniform(0, behaviour['jitter_ms'])
+        if latency:
+            time.sleep(latency / 1000.)
+
+        errors = behaviour['errors']
+        if errors['drop'] and self.config.uniform(0, 1) < errors['drop']:
+            self.count('drops')
+            raise BadStatusLine('')
+        if errors['rate'] and self.config.uniform(0, 1) < errors['rate']:
+            self.count('errors')
+            status, headers, content = _error(self.config.choice(errors['statuses']), "Injected error")
+            if errors['retry_after'] is not None:
+                headers['retry-after'] = str(errors['retry_after'])
+            return status, headers, content
+
+        for name, values in urlparse.parse_qs(query, keep_blank_values=True).iteritems():
+            params[name] = values if len(values) > 1 else values[0]
+        try:
+            request_body = json.loads(body) if body else None
+        except ValueError:
+            request_body = body
+
+        if behaviour['response'] is not None:
+            request = dict(params, body=request_body)
+            response = behaviour['response'].render(lambda expression: _resolve(request, expression), copy=True)
+        elif 'request' in description and isinstance(request_body, dict):
+            response = request_body
+        else:
+            response = {}
+
+        if int(behaviour['status']) == 204:
+            return 204, {}, ''
+        return int(behaviour['status']), {'content-type': 'application/json'}, json.dumps(response)
+
+    def batch(self, body, headers):
+        """
+        Answer the requests of a batch request, each in its own part of the response
+        """
+        import email
+
+        message = email.message_from_string("Content-Type: {}\r\n\r\n{}".format(headers.get('content-type', ''),
+                                                                                body or ''))
+        parts = []
+        for part in message.get_payload() if message.is_multipart() else []:
+            payload = part.get_payload()
+            head, _, sub_body = payload.partition("\r\n\r\n") if "\r\n\r\n" in payload else payload.partition("\n\n")
+            method, path = head.split()[:2]
+            try:
+                status, _, content = self.answer(method, path, sub_body)
+            except BadStatusLine:
+                # a single request cannot be dropped, the whole batch is
+                raise
+            parts.append("--BOUNDARY\r\nContent-Type: application/http\r\nContent-ID: <response-{}>\r\n\r\n"
+                         "HTTP/1.1 {} Mock\r\nContent-Type: application/json\r\nContent-Length: {}\r\n\r\n{}\r\n".format(
+                             (part['Content-ID'] or '').strip('<>'), status, len(content), content))
+
+        return 200, {'content-type': 'multipart/mixed; boundary=BOUNDARY'}, "".join(parts) + "--BOUNDARY--\r\n"
+
+
+def _error(status, message):
+    return status, {'content-type': 'application/json'}, json.dumps(
+        {'error': {'code': status, 'message': message, 'errors': [{'message': message}]}})
+
+
+def _resolve(request, expression):
+    expression = expression.strip()
+    as_list = expression.endswith("as list")
+    if as_list:
+        expression = expression.replace("as list", "").strip()
+    results = jsonpath(request, expression, first=not as_list)
+    if not results:
+        return [] if as_list else None
+    return results if as_list else results[0]
+
+
+class MockHttp(object):
+    """
+    An httplib2.Http stand-in answering the requests with a mock backend, without network access
+    """
+    def __init__(self, backend):
+        self.backend = backend
+
+    def request(self, uri, method='GET', body=None, headers=None, *args, **kwargs):
+        from httplib2 import Response
+
+        status, response_headers, content = self.backend.handle(method, uri, body, headers)
+        response_headers = dict(response_headers, status=str(status))
+        return Response(response_headers), content
+
+
+def get_document(service_config):
+    """
+    The discovery document of a service given in the mock configuration, None if there is none
+    """
+    if not settings['config']:
+        return None
+    return settings['config'].document(service_config['api'], service_config['version'])
+
+
+def get_backend(document):
+    """
+    Return the mock backend of a discovery document, shared by the services of the same document
+    """
+    key = hashlib.sha1(document).hexdigest()
+    with _lock:
+        if key not in _backends:
+            _backends[key] = MockBackend([document], settings['config'])
+        return _backends[key]
+
+
+def serve(address, config=None):
+    """
+    Serve the documents of the mock configuration over HTTP until interrupted
+
+    `address` is a port or `host:port`. The discovery documents are served
+    at `/discovery/{api}/{version}/rest`, their root url being the mock
+    server one.
+    """
+    import SocketServer
+    import BaseHTTPServer
+
+    config = config or settings['config']
+    if not config or not config.documents:
+        raise ValueError("The mock server needs a configuration with discovery documents")
+
+    host, _, port = str(address).rpartition(':')
+    host = host or 'localhost'
+    root_url = 'http://{}:{}/'.format(host, port)
+
+    documents = {}
+    for (api, version), content in config.documents.iteritems():
+        document = json.loads(content)
+        document['rootUrl'] = root_url
+        document['baseUrl'] = root_url + document.get('servicePath', '')
+        documents['/discovery/{}/{}/rest'.format(api, version)] = json.dumps(document)
+    backend = MockBackend(documents.values(), config)
+
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        # the responses are written at once, without waiting for the acknowledgement of their headers
+        wbufsize = -1
+        disable_nagle_algorithm = True
+
+        def log_message(self, *args):
+            pass
+
+        def send(self, status, headers, content):
+            self.send_response(status)
+            for name, value in headers.iteritems():
+                self.send_header(name, value)
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+            self.wfile.flush()
+
+        def handle_request(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            body = self.rfile.read(length) if length else None
+            path = urlparse.urlsplit(self.path).path
+            if self.command == 'GET' and path in documents:
+                return self.send(200, {'content-type': 'application/json'}, documents[path])
+            try:
+                self.send(*backend.handle(self.command, self.path, body, dict(self.headers)))
+            except BadStatusLine:
+                self.close_connection = 1
+                self.wfile.flush()
+
+        do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = handle_request
+
+    class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+        daemon_threads = True
+        allow_reuse_address = True
+
+    server = Server((host, int(port)), Handler)
+    print "Mock server listening on {}, discovery documents:".format(root_url)
+    for path in sorted(documents):
+        print "  {}{}".format(root_url.rstrip('/'), path)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    print "\n{}Mock server: {} call(s), {} error(s), {} drop(s){}".format(
+        ju.bold, backend.stats['calls'], backend.stats['errors'], backend.stats['drops'], ju.end_color)
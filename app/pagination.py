@@ -0,0 +1,108 @@
+import threading
+
+from multiprocessing.pool import ThreadPool
+
+# the number of pages fetched in the background at the same time, for all the commands
+PREFETCH_THREADS = 4
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def prefetch(func, *args):
+    """
+    Call `func(*args)` in a background thread, returns an AsyncResult
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPool(processes=PREFETCH_THREADS)
+    return _pool.apply_async(func, args)
+
+
+class Paginator(object):
+    """
+    Follow the page tokens of a list endpoint
+
+    The configuration is either True or a dict with:
+
+    - `token`: the request argument receiving the page token (`pageToken`)
+    - `next_token`: the result field holding the next page token (`nextPageToken`)
+    - `items`: the result field holding the entries of a page (`items`)
+    - `max_pages`: the maximum number of pages to fetch, no limit by default
+    - `prefetch`: fetch the next page while the current one is processed (True)
+    - `mode`: `merge` (default) to handle all the entries as a single result,
+      or `stream` to handle each page as a result of its own
+    """
+    def __init__(self, config):
+        if config is True:
+            config = {}
+        if not isinstance(config, dict):
+            raise ValueError("paginate must be either true or a dict")
+
+        self.token = config.get('token', 'pageToken')
+        self.next_token = config.get('next_token', 'nextPageToken')
+        self.items = config.get('items', 'items')
+        self.max_pages = config.get('max_pages')
+        self.prefetch = config.get('prefetch', True)
+        self.mode = config.get('mode', 'merge')
+
+        if self.mode not in ('merge', 'stream'):
+            raise ValueError("The pagination mode must be either merge or stream")
+        if self.max_pages is not None and (not isinstance(self.max_pages, int) or self.max_pages < 1):
+            raise ValueError("max_pages must be a positive number")
+
+    def pages(self, first, fetch, fetch_async=None):
+        """
+        Iterate over the pages, starting with the `first` one
+
+        `fetch(token)` returns the page of a token, `fetch_async(token)` an
+        AsyncResult of it, used to get the next page while the current one is
+        processed. Yields (page, True if it is the last page).
+        """
+        page = first
+        nb_pages = 1
+        seen = set()
+
+        while True:
+            token = page.get(self.next_token) if isinstance(page, dict) else None
+            # a token given twice would loop forever
+            last = not token or token in seen or (self.max_pages and nb_pages >= self.max_pages)
+
+            pending = None
+            if not last:
+                seen.add(token)
+                if self.prefetch and fetch_async:
+                    pending = fetch_async(token)
+
+            yield page, bool(last)
+            if last:
+                return
+
+            page = pending.get() if pending else fetch(token)
+            nb_pages += 1
+
+    def strip(self, page):
+        """
+        The page without its next page token, as the merged result
+        """
+        if not isinstance(page, dict) or self.next_token not in page:
+            return page
+        page = dict(page)
+        del page[self.next_token]
+        return page
+
+    def merge(self, pages):
+        """
+        Merge the entries of the pages into the first one, without the next page token
+        """
+        merged = None
+        for page, _ in pages:
+            if merged is None:
+                merged = dict(page)
+                merged[self.items] = list(page.get(self.items, []))
+            else:
+                merged[self.items].extend(page.get(self.items, []))
+
+        merged.pop(self.next_token, None)
+        return merged
@@ -0,0 +1,297 @@
+import sys
+import json
+import time
+import threading
+
+from collections import OrderedDict
+
+import utils as ju
+
+# the number of lines a thread keeps before writing them to the console
+CONSOLE_BUFFER_SIZE = 1000
+
+
+class ConsoleSink(object):
+    """
+    Print the results of the checks
+
+    The lines of each thread are kept and written at once, before any other
+    event of the thread or when `flush` is called.
+    """
+    console = True
+
+    def __init__(self, buffer_size=CONSOLE_BUFFER_SIZE):
+        self.buffer_size = buffer_size
+        self.local = threading.local()
+
+    def lines(self):
+        if not hasattr(self.local, 'lines'):
+            self.local.lines = []
+        return self.local.lines
+
+    def handle(self, event):
+        if event['event'] != 'assertion':
+            self.flush()
+            return
+
+        lines = self.lines()
+        if event['path'] is not None:
+            if event['passed']:
+                lines.append(u" ".join([ju.info_color, event['path'], ju.success_color, ju.bold, "DONE", ju.end_color]))
+            else:
+                lines.append(u" ".join([ju.info_color, event['path'], ju.error_color, ju.bold, "FAILURE", ju.end_color]))
+            if len(lines) >= self.buffer_size:
+                self.flush()
+        elif not event['passed']:
+            # a failed check without path is shown in a box
+            lines.extend([ju.error_color if event['fatal'] else ju.warning_color,
+                          "*" * ju.tty_columns,
+                          u"{} :  {}".format("* FAIL" if event['fatal'] else "* WARNING", event['message']),
+                          "*" * ju.tty_columns,
+                          ju.end_color])
+            self.flush()
+
+    def flush(self):
+        lines = self.lines()
+        if lines:
+            sys.stdout.write(u"\n".join(lines) + u"\n")
+            del lines[:]
+
+    def close(self):
+        self.flush()
+
+
+class JsonLinesSink(object):
+    """
+    Write each event as a json object on its own line
+    """
+    console = False
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = open(path, 'w')
+
+    def handle(self, event):
+        line = json.dumps(event) + "\n"
+        with self.lock:
+            self.file.write(line)
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+class JUnitSink(object):
+    """
+    Write a JUnit XML report, with a test suite per scenario and a test case per command
+
+    A command fails when it raises an error or when one of its checks fails.
+    The failed checks made outside of the commands are reported in a
+    `scenario` test case.
+    """
+    console = False
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        # scenario -> {'cases': [...], 'time': seconds, 'timestamp': time}
+        self.suites = OrderedDict()
+        # (scenario, position, key) -> [failed, messages]
+        self.checks = {}
+
+    def handle(self, event):
+        kind = event['event']
+        with self.lock:
+            if kind == 'scenario_start':
+                self.suites.setdefault(event['scenario'], {'cases': [], 'time': 0, 'timestamp': event['time']})
+
+            elif kind == 'assertion' and not event['passed']:
+                checks = self.checks.setdefault((event['scenario'], event['position'], event['key']), [False, []])
+                if event['path'] is not None:
+                    checks[0] = True
+                    checks[1].append(u"{} does not match the expectation".format(event['path']))
+                else:
+                    checks[0] = checks[0] or event['key'] is None
+                    checks[1].append(event['message'])
+
+            elif kind == 'command_end':
+                failed, messages = self.checks.pop((event['scenario'], event['position'], event['key']), [False, []])
+                if event['error'] and event['message']:
+                    messages.append(event['message'])
+                self.suite(event['scenario'])['cases'].append({
+                    'position': event['position'],
+                    'name': u"{} {}".format(event['position'], event['key']),
+                    'time': event['duration'],
+                    'failure': messages if event['error'] or failed else None,
+                })
+
+            elif kind == 'scenario_end':
+                suite = self.suite(event['scenario'])
+                suite['time'] = event['duration']
+                failed, messages = self.checks.pop((event['scenario'], None, None), [False, []])
+                if failed:
+                    suite['cases'].append({'position': None, 'name': u"scenario", 'time': 0, 'failure': messages})
+
+    def suite(self, scenario):
+        return self.suites.setdefault(scenario, {'cases': [], 'time': 0, 'timestamp': time.time()})
+
+    def close(self):
+        from xml.sax.saxutils import escape, quoteattr
+
+        with self.lock:
+            suites = self.suites.items()
+
+        nb_tests = sum(len(suite['cases']) for _, suite in suites)
+        nb_failures = sum(1 for _, suite in suites for case in suite['cases'] if case['failure'] is not None)
+        lines = [u'<?xml version="1.0" encoding="UTF-8"?>',
+                 u'<testsuites tests="{}" failures="{}" time="{:.3f}">'.format(
+                     nb_tests, nb_failures, sum(suite['time'] for _, suite in suites))]
+        for name, suite in suites:
+            lines.append(u'  <testsuite name={} tests="{}" failures="{}" errors="0" time="{:.3f}" timestamp="{}">'.format(
+                quoteattr(unicode(name)), len(suite['cases']),
+                sum(1 for case in suite['cases'] if case['failure'] is not None), suite['time'],
+                time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(suite['timestamp']))))
+            # the concurrent commands end in any order
+            for case in sorted(suite['cases'], key=lambda case: (case['position'] is None, case['position'])):
+                attributes = u'classname={} name={} time="{:.3f}"'.format(
+                    quoteattr(unicode(name)), quoteattr(case['name']), case['time'])
+                if case['failure'] is None:
+                    lines.append(u'    <testcase {}/>'.format(attributes))
+                else:
+                    messages = [unicode(message) for message in case['failure']] or [u"The command failed"]
+                    lines.append(u'    <testcase {}>'.format(attributes))
+                    lines.append(u'      <failure message={}>{}</failure>'.format(
+                        quoteattr(messages[0]), escape(u"\n".join(messages))))
+                    lines.append(u'    </testcase>')
+            lines.append(u'  </testsuite>')
+        lines.append(u'</testsuites>')
+
+        with open(self.path, 'w') as f:
+            f.write(u"\n".join(lines).encode('utf-8') + "\n")
+
+
+class EventList(object):
+    """
+    Keep the events, to be replayed by another process
+    """
+    console = False
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.events = []
+
+    def handle(self, event):
+        with self.lock:
+            self.events.append(event)
+
+    def close(self):
+        pass
+
+
+class Reporter(object):
+    """
+    Send the events of the scenarios to the sinks
+
+    The events are dicts with an `event` kind (`scenario_start`,
+    `scenario_end`, `command_start`, `command_end`, `assertion` or
+    `timing`), a `time` and the `scenario`, `position` and `key` of the
+    command they belong to.
+    """
+    def __init__(self, sinks=None):
+        self.sinks = sinks if sinks is not None else [ConsoleSink()]
+        # the running scenarios and command of each thread
+        self.local = threading.local()
+
+    def emit(self, kind, **fields):
+        fields['event'] = kind
+        fields['time'] = time.time()
+        for sink in self.sinks:
+            sink.handle(fields)
+
+    def context(self):
+        """
+        The scenario, position and key of the command running in the current thread
+        """
+        command = getattr(self.local, 'command', None)
+        if command:
+            return command
+        scenarios = getattr(self.local, 'scenarios', None)
+        return scenarios[-1] if scenarios else None, None, None
+
+    def scenario_start(self, scenario):
+        if not hasattr(self.local, 'scenarios'):
+            self.local.scenarios = []
+        self.local.scenarios.append(scenario)
+        self.emit('scenario_start', scenario=scenario)
+
+    def scenario_end(self, scenario, error, duration):
+        if getattr(self.local, 'scenarios', None):
+            self.local.scenarios.pop()
+        self.emit('scenario_end', scenario=scenario, error=bool(error), duration=duration)
+
+    def command_start(self, scenario, position, key):
+        self.local.command = (scenario, position, key)
+        self.emit('command_start', scenario=scenario, position=position, key=key)
+
+    def command_end(self, scenario, position, key, error, duration, message=None):
+        self.local.command = None
+        self.emit('command_end', scenario=scenario, position=position, key=key, error=bool(error),
+                  duration=duration, message=message)
+
+    def assertion(self, path, passed, message=None, fatal=False):
+        """
+        The result of a check, `path` is the checked path of the result if any
+        """
+        scenario, position, key = self.context()
+        self.emit('assertion', scenario=scenario, position=position, key=key, path=path, passed=bool(passed),
+                  message=message, fatal=fatal)
+
+    def timing(self, scenario, position, key, phase, seconds, calls=1):
+        self.emit('timing', scenario=scenario, position=position, key=key, phase=phase, seconds=seconds,
+                  calls=calls)
+
+    def flush(self):
+        """
+        Write the console lines kept by the current thread
+        """
+        for sink in self.sinks:
+            if sink.console:
+                sink.flush()
+
+    def replay(self, events):
+        """
+        Send the events of another process to the sinks, but the console one
+        """
+        for event in events:
+            for sink in self.sinks:
+                if not sink.console:
+                    sink.handle(event)
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+
+
+def configure(junit=None, json_lines=None):
+    """
+    Add the sinks writing a JUnit XML report and the events as json lines to the given files
+    """
+    if junit:
+        reporter.sinks.append(JUnitSink(junit))
+    if json_lines:
+        reporter.sinks.append(JsonLinesSink(json_lines))
+
+
+def capture():
+    """
+    Keep the events in a list rather than writing them to the files, returns the list
+
+    Used by the worker processes, the main process replays their events.
+    """
+    events = EventList()
+    reporter.sinks = [sink for sink in reporter.sinks if sink.console] + [events]
+    return events
+
+
+reporter = Reporter()
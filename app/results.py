@@ -0,0 +1,282 @@
+import os
+import sys
+import json
+import shutil
+import cPickle
+import resource
+import tempfile
+import threading
+
+from jsonpath import jsonpath
+
+from app import concurrency
+from app.template import expression_matcher
+
+# the leaves of a projection tree
+_keep = True
+
+
+def _strip(expression):
+    match = expression_matcher.match(expression)
+    return (match.group(1) if match else expression).strip()
+
+
+def _materialize(value, tree):
+    if tree is _keep:
+        return value
+    if isinstance(value, list):
+        return [_materialize(value[idx], tree[idx]) for idx in sorted(tree)]
+    return dict((key, _materialize(value[key], subtree)) for key, subtree in tree.iteritems())
+
+
+def project(value, expressions):
+    """
+    Keep only the parts of a json value matched by some jsonpath expressions
+
+    The structure of the value is kept: `$.items[*].id` gives
+    `{"items": [{"id": ...}, ...]}`. Lists only keep their matched entries,
+    in their original order. The kept leaves are shared with the value.
+    """
+    tree = {}
+    for expression in expressions:
+        expression = _strip(expression)
+        if expression in ('$', ''):
+            return value
+
+        paths = jsonpath(value, expression, result_type='IPATH')
+        for path in paths or []:
+            node, current = tree, value
+            for idx, key in enumerate(path):
+                if isinstance(current, list):
+                    key = int(key)
+                if node is _keep:
+                    # a parent is already fully kept
+                    break
+                if idx == len(path) - 1:
+                    node[key] = _keep
+                else:
+                    node = node.setdefault(key, {})
+                current = current[key]
+
+    return _materialize(value, tree)
+
+
+class Exporter(object):
+    """
+    Write the results of a command to a file
+
+    The configuration is either a file name, the result is then written as
+    indented json, or a dict with:
+
+    - `file`: the file name
+    - `format`: `json` (default) to write the last result, or `lines` to
+      write each result of a repeated command as a json line, the default
+      for the pages of a streamed pagination
+    - `indent`: False for compact json
+    - `items`: a jsonpath expression, each matched value (or each entry of a
+      matched list) is written as a json line rather than the whole result
+    """
+    def __init__(self, config):
+        if isinstance(config, basestring):
+            config = {'file': config}
+        if not isinstance(config, dict) or 'file' not in config:
+            raise ValueError("export_result must be a file name or a dict with a `file` key")
+
+        self.filename = config['file']
+        self.format = config.get('format')
+        self.lines = self.format == 'lines' or 'items' in config
+        self.indent = 4 if config.get('indent', not self.lines) else None
+        self.items = _strip(config['items']) if 'items' in config else None
+        self.started = False
+
+    def stream(self):
+        """
+        Write each result as a json line, each page of a streamed pagination being a result
+        """
+        if self.format == 'json':
+            raise ValueError("The pages of a streamed pagination cannot be exported in the json format, use lines")
+        self.lines = True
+        self.indent = None
+
+    def write(self, result):
+        # a repeated command appends its results in `lines` format
+        mode = 'a' if self.lines and self.started else 'w'
+        self.started = True
+
+        with open(self.filename, mode) as f:
+            if not self.lines:
+                # json.dump writes the document chunk by chunk
+                json.dump(result, f, indent=self.indent, separators=(',', ': ') if self.indent else (',', ':'))
+                return
+
+            values = [result]
+            if self.items:
+                values = []
+                for match in jsonpath(result, self.items) or []:
+                    values.extend(match if isinstance(match, list) else [match])
+
+            for value in values:
+                json.dump(value, f, separators=(',', ':'))
+                f.write('\n')
+
+
+def current_memory():
+    """
+    The resident memory of the process, in MB, None where /proc is not available
+    """
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            pages = int(f.read().split()[1])
+    except (IOError, ValueError, IndexError):
+        return None
+    return pages * resource.getpagesize() / 1024. / 1024.
+
+
+def peak_memory():
+    """
+    The peak resident memory of the process, in MB
+    """
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on mac
+    if sys.platform == 'darwin':
+        usage /= 1024
+    return usage / 1024.
+
+
+class ResultStore(dict):
+    """
+    The saved results of a scenario
+
+    Once the commands to run are planned, the store knows statically which
+    commands read each result. With `evict`, a result is dropped as soon as
+    no command left to run reads it. With `spill`, a folder (or True for a
+    temporary one), the results not read by the next `spill_after` commands
+    are written to disk and loaded back before the command reading them.
+    """
+    def __init__(self, evict=False, spill=None, spill_after=10):
+        dict.__init__(self)
+        self.evict = evict
+        self.spill_after = spill_after
+        self.spill_folder = None
+        self.own_folder = False
+        if spill:
+            if spill is True:
+                self.spill_folder = tempfile.mkdtemp(prefix='lumrest-')
+                self.own_folder = True
+            else:
+                self.spill_folder = spill
+                if not os.path.isdir(spill):
+                    os.makedirs(spill)
+
+        # name -> spill file
+        self.spilled = {}
+        # name -> indexes of the commands left to run reading it, sorted
+        self.readers = {}
+        # command index -> names it reads
+        self.reads = {}
+        # indexes of the commands left to run which may read any result
+        self.reads_all = set()
+        self.planned = False
+        self.lock = threading.RLock()
+        # `memory`: the resident memory at the start of the scenario and `max_memory` once a command is done, in MB
+        self.stats = {'peak': 0, 'evicted': 0, 'spilled': 0, 'memory': None, 'max_memory': None}
+
+    def plan(self, commands, load_file=None):
+        """
+        Record the results read by each command, indexed by their position in `commands`
+
+        The references are found as for the concurrency, a command reading
+        `$..x`, `$.*` or `$[0]` may read any result and keeps them all until
+        it is run.
+        """
+        for idx, command in enumerate(commands):
+            deps = concurrency.command_dependencies(command, load_file)
+            if deps.reads_all:
+                self.reads_all.add(idx)
+            self.reads[idx] = deps.reads
+            for name in deps.reads:
+                self.readers.setdefault(name, []).append(idx)
+        self.planned = bool(self.evict or self.spill_folder)
+        if self.planned:
+            self.stats['memory'] = self.stats['max_memory'] = current_memory()
+
+    def before(self, idx):
+        """
+        Load back the spilled results read by a command
+        """
+        if not self.planned:
+            return
+        with self.lock:
+            names = self.spilled.keys() if idx in self.reads_all else self.reads.get(idx, ())
+            for name in names:
+                if name in self.spilled:
+                    self.__restore(name)
+
+    def after(self, idx):
+        """
+        Drop or spill the results which are not needed soon once a command is done
+        """
+        with self.lock:
+            self.stats['peak'] = max(self.stats['peak'], len(self))
+            if not self.planned:
+                return
+
+            memory = current_memory()
+            if memory is not None:
+                self.stats['max_memory'] = max(self.stats['max_memory'], memory)
+
+            self.reads_all.discard(idx)
+            for name in self.reads.pop(idx, ()):
+                if idx in self.readers.get(name, ()):
+                    self.readers[name].remove(idx)
+
+            for name in self.keys():
+                next_use = self.__next_use(name)
+                if next_use is None:
+                    if self.evict:
+                        dict.__delitem__(self, name)
+                        self.stats['evicted'] += 1
+                elif self.spill_folder and next_use - idx > self.spill_after:
+                    self.__spill(name)
+
+    def close(self):
+        """
+        Remove the spilled results
+        """
+        for path in self.spilled.itervalues():
+            if os.path.isfile(path):
+                os.remove(path)
+        self.spilled = {}
+        if self.own_folder and os.path.isdir(self.spill_folder):
+            shutil.rmtree(self.spill_folder)
+
+    def __next_use(self, name):
+        uses = self.readers.get(name, [])[:1] + sorted(self.reads_all)[:1]
+        return min(uses) if uses else None
+
+    def __spill(self, name):
+        path = os.path.join(self.spill_folder, '{}-{}.pickle'.format(id(self), self.stats['spilled']))
+        with open(path, 'wb') as f:
+            cPickle.dump(dict.__getitem__(self, name), f, cPickle.HIGHEST_PROTOCOL)
+        dict.__delitem__(self, name)
+        self.spilled[name] = path
+        self.stats['spilled'] += 1
+
+    def __restore(self, name):
+        path = self.spilled.pop(name)
+        with open(path, 'rb') as f:
+            dict.__setitem__(self, name, cPickle.load(f))
+        os.remove(path)
+
+    def __setitem__(self, name, value):
+        with self.lock:
+            if name in self.spilled:
+                os.remove(self.spilled.pop(name))
+            dict.__setitem__(self, name, value)
+
+    def __missing__(self, name):
+        with self.lock:
+            if name not in self.spilled:
+                raise KeyError(name)
+            self.__restore(name)
+            return dict.__getitem__(self, name)
@@ -0,0 +1,204 @@
+import time
+import random
+import threading
+
+from httplib import BadStatusLine
+
+# the responses retried once a retry policy is configured, the connection drops are always retried
+DEFAULT_STATUSES = (429, 503)
+
+DEFAULTS = {
+    'attempts': 5,
+    'delay': 1.,
+    'multiplier': 2.,
+    'max_delay': 30.,
+    'jitter': .5,
+    'statuses': DEFAULT_STATUSES,
+    'retry_after': True,
+}
+
+
+def backoff_delay(delay, times, multiplier=1., max_delay=None, jitter=0.):
+    """
+    The time to wait before the call following `times` calls
+
+    The `delay` is multiplied by `multiplier` after each call, up to
+    `max_delay`, then a random part of it, `jitter` being its ratio, is
+    removed so that the clients do not call again at the same time.
+    """
+    wait = delay * multiplier ** times
+    if max_delay is not None:
+        wait = min(wait, max_delay)
+    if jitter:
+        wait *= 1 - jitter * random.random()
+    return wait
+
+
+def retry_after(exception):
+    """
+    The number of seconds a response asks to wait, given in seconds or as a date by its Retry-After header
+    """
+    resp = getattr(exception, 'resp', None)
+    value = resp.get('retry-after') if resp is not None else None
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.)
+    except ValueError:
+        from email.utils import parsedate_tz, mktime_tz
+        date = parsedate_tz(value)
+        return max(mktime_tz(date) - time.time(), 0.) if date else None
+
+
+def status_of(exception):
+    """
+    The HTTP status of an error response, None if there was no response
+    """
+    resp = getattr(exception, 'resp', None)
+    return str(resp['status']) if resp is not None and 'status' in resp else None
+
+
+class RetryBudget(object):
+    """
+    The number of retries left to the commands of a scenario
+    """
+    def __init__(self, retries):
+        if not isinstance(retries, int) or retries < 0:
+            raise ValueError("The retry budget must be a positive number of retries")
+        self.lock = threading.Lock()
+        self.left = retries
+
+    def take(self):
+        """
+        Use a retry, returns False if there is none left
+        """
+        with self.lock:
+            if self.left <= 0:
+                return False
+            self.left -= 1
+            return True
+
+
+class RetryPolicy(object):
+    """
+    When and how long to wait before calling an endpoint again
+
+    The configuration is either False, to never retry, or a dict with:
+
+    - `attempts`: the maximum number of calls (5)
+    - `delay`: the time to wait before the first retry, in seconds (1)
+    - `multiplier`: by how much the delay grows after each retry (2)
+    - `max_delay`: the maximum time to wait, in seconds (30)
+    - `jitter`: the random ratio of the delay removed from it (0.5)
+    - `statuses`: the status codes to retry, `5xx` is any 5XX status
+      ([429, 503])
+    - `retry_after`: wait as long as the Retry-After header asks (True)
+    - `budget`: the maximum number of retries for all the commands of the
+      scenario, no limit by default
+    """
+    def __init__(self, config=None, budget=None):
+        if config is None or config is True:
+            config = {}
+        elif config is False:
+            config = {'attempts': 1}
+        if not isinstance(config, dict):
+            raise ValueError("retry must be either a boolean or a dict")
+
+        unknown = set(config) - set(DEFAULTS) - set(['budget'])
+        if unknown:
+            raise ValueError("Unknown retry keys: {}".format(", ".join(sorted(unknown))))
+
+        self.config = dict(DEFAULTS)
+        self.config.update((key, value) for key, value in config.iteritems() if key != 'budget')
+        if not isinstance(self.config['attempts'], int) or self.config['attempts'] < 1:
+            raise ValueError("The number of retry attempts must be a positive number")
+
+        if not isinstance(self.config['statuses'], (list, tuple)):
+            raise ValueError("The retried statuses must be a list")
+
+        self.budget = RetryBudget(config['budget']) if 'budget' in config else budget
+        self.statuses = [str(status).lower() for status in self.config['statuses']]
+
+    def override(self, config):
+        """
+        The policy of a command, its configuration is merged with this one and it uses the same budget
+
+        Without a policy for the scenario, the configuration of the command is
+        merged with the defaults.
+        """
+        if config is True:
+            return self if self is not default_policy else RetryPolicy()
+        if config is False:
+            return RetryPolicy(False, budget=self.budget)
+        if not isinstance(config, dict):
+            raise ValueError("retry must be either a boolean or a dict")
+        if 'budget' in config:
+            raise ValueError("The retry budget can only be set for a scenario")
+
+        merged = dict(DEFAULTS if self is default_policy else self.config)
+        merged.update(config)
+        return RetryPolicy(merged, budget=self.budget)
+
+    def reason(self, exception, expected=None, statuses=True):
+        """
+        Why a failed call can be retried, None if it cannot
+        """
+        if isinstance(exception, BadStatusLine):
+            return "connection closed"
+
+        status = status_of(exception)
+        if not statuses or status is None or status == str(expected):
+            return None
+        if any(status == code or (code.endswith('xx') and status[0] == code[0]) for code in self.statuses):
+            return "status {}".format(status)
+        return None
+
+    def wait(self, retries, exception):
+        """
+        The time to wait before the retry following `retries` retries
+        """
+        config = self.config
+        wait = backoff_delay(config['delay'], retries, config['multiplier'], config['max_delay'], config['jitter'])
+        if config['retry_after']:
+            asked = retry_after(exception)
+            if asked is not None:
+                wait = min(asked, config['max_delay']) if config['max_delay'] is not None else asked
+        return wait
+
+    def call(self, func, label, stats=None, expected=None, statuses=True):
+        """
+        Call `func` until it succeeds or cannot be retried, the last error is raised
+
+        A closed connection is retried, as well as the error responses of the
+        retried statuses unless the status is the `expected` one or
+        `statuses` is False. `stats` is a dict receiving the number of
+        `retries` and the `seconds` spent in the failed calls and the waits.
+        `label` describes the call in the retry messages, either a string or a
+        function returning it, only called when the call is retried.
+        """
+        if stats is None:
+            stats = {}
+        stats.setdefault('retries', 0)
+        stats.setdefault('seconds', 0.)
+
+        attempt = 0
+        while True:
+            attempt += 1
+            attempt_time = time.time()
+            try:
+                return func()
+            except Exception as e:
+                reason = self.reason(e, expected, statuses)
+                if reason is None or attempt >= self.config['attempts'] or \
+                        (self.budget is not None and not self.budget.take()):
+                    raise
+                wait = self.wait(attempt - 1, e)
+
+            print "RETRYING: {} ({}), in {:.1f}s".format(label() if callable(label) else label, reason, wait)
+            time.sleep(wait)
+            stats['retries'] += 1
+            stats['seconds'] += time.time() - attempt_time
+
+
+# the policy without a retry configuration: the closed connections are retried after a second, not the statuses
+default_policy = RetryPolicy({'statuses': [], 'multiplier': 1., 'jitter': 0., 'retry_after': False})
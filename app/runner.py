@@ -0,0 +1,168 @@
+import os
+import sys
+import glob
+import traceback
+
+from multiprocessing import Pool
+from StringIO import StringIO
+
+from app import default
+from app import files
+from app import timing
+from app import report
+from app import startup
+import utils as ju
+
+SCENARIO_EXTENSIONS = ('.yaml', '.yml')
+
+
+def find_scenarios(paths):
+    """
+    Expand the given paths into a list of scenario files
+
+    Each path can be a scenario file, a glob pattern or a directory (in which
+    case every yaml file it contains, recursively, is used). The order of the
+    arguments is kept and duplicates are removed.
+    """
+    found = []
+    for path in paths:
+        if os.path.isdir(path):
+            candidates = []
+            for root, _, names in os.walk(path):
+                candidates.extend([os.path.join(root, name) for name in names
+                                   if os.path.splitext(name)[1] in SCENARIO_EXTENSIONS])
+            candidates.sort()
+        elif os.path.isfile(path):
+            candidates = [path]
+        else:
+            candidates = sorted(p for p in glob.glob(path) if os.path.isfile(p))
+
+        if not candidates:
+            raise ValueError("{} does not match any scenario file".format(path))
+
+        for candidate in candidates:
+            candidate = os.path.abspath(candidate)
+            if candidate not in found:
+                found.append(candidate)
+
+    return found
+
+
+def load_scenario(scenario_file):
+    """
+    Load a scenario file, returns the scenario and its root folder
+    """
+    scenario_root = os.path.abspath(os.path.join(os.path.abspath(scenario_file), os.pardir))
+    return files.load_scenario(scenario_file), scenario_root
+
+
+def run_scenario(scenario_file, config, exit_on_error=False):
+    """
+    Run a single scenario file
+
+    Return a boolean (True if an error occurred, else False)
+    """
+    try:
+        scene, scenario_root = load_scenario(scenario_file)
+        command_parser = default.CommandParser(config, scene, scenario_root, exit_on_error=exit_on_error,
+                                               scenario_file=scenario_file)
+        return bool(command_parser.parse())
+    except SystemExit as e:
+        # skipped scenarios exit with a 0 code
+        return bool(e.code)
+    except Exception as e:
+        print "{}{}Unable to run scenario:{} {}{}{}\n{}".format(
+            ju.error_color, ju.bold, ju.end_color,
+            ju.error_color_detail, scenario_file, ju.end_color, e)
+        print traceback.format_exc()
+        return True
+
+
+def _run_captured(args):
+    """
+    Run a scenario in a worker, its output and report events are kept and
+    returned with the result so that the scenarios outputs are not interleaved
+    """
+    scenario_file, config, exit_on_error, timing_settings = args
+    timing.configure(**timing_settings)
+    timing.timings.clear()
+    events = report.capture()
+    startup.profile.clear()
+    stdout = sys.stdout
+    sys.stdout = StringIO()
+    stats = default.service_pool_stats()
+    try:
+        error = run_scenario(scenario_file, config, exit_on_error=exit_on_error)
+        pool_stats = dict((k, v - stats[k]) for k, v in default.service_pool_stats().iteritems())
+        return (scenario_file, error, sys.stdout.getvalue(), pool_stats, timing.timings.rows(), events.events,
+                startup.profile.rows())
+    finally:
+        sys.stdout = stdout
+
+
+def run_scenarios(scenario_files, config, exit_on_error=False, jobs=1):
+    """
+    Run several scenario files, using a pool of `jobs` worker processes
+
+    When several jobs are used, the output of each scenario is printed at
+    once, in the order of the given files. If `exit_on_error` is set, the
+    remaining scenarios are cancelled after the first failing one.
+
+    Return a boolean (True if at least one scenario failed, else False)
+    """
+    failures = []
+    nb_run = 0
+    pool = None
+    pool_stats = default.service_pool_stats()
+
+    try:
+        if jobs > 1:
+            pool = Pool(processes=jobs)
+            results = pool.imap(_run_captured, [(scenario_file, config, exit_on_error, timing.settings)
+                                                for scenario_file in scenario_files])
+        else:
+            # no need to capture the output, the scenarios are run one at a time
+            results = ((scenario_file, None, None, None, None, None, None) for scenario_file in scenario_files)
+
+        for scenario_file, error, output, stats, timing_rows, events, startup_rows in results:
+            print "{}{}==> {}{}".format(ju.bold, ju.info_color, scenario_file, ju.end_color)
+            if pool:
+                sys.stdout.write(output)
+                sys.stdout.flush()
+                for k, v in stats.iteritems():
+                    pool_stats[k] += v
+                # the timings, report events and startup steps of the workers are reported by the main process
+                timing.timings.merge(timing_rows)
+                report.reporter.replay(events)
+                startup.profile.merge(startup_rows)
+            else:
+                error = run_scenario(scenario_file, config, exit_on_error=exit_on_error)
+
+            nb_run += 1
+            if error:
+                failures.append(scenario_file)
+                if exit_on_error:
+                    break
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
+
+    if not pool:
+        pool_stats = default.service_pool_stats()
+
+    print "\n{}{} scenario(s) run, {} failed{}".format(ju.bold, nb_run, len(failures), ju.end_color)
+    print_service_pool_stats(pool_stats)
+    for scenario_file in failures:
+        print "{}FAILED: {}{}".format(ju.error_color, scenario_file, ju.end_color)
+
+    return len(failures) > 0
+
+
+def print_service_pool_stats(stats=None):
+    """
+    Print how many services were reused during the run
+    """
+    if stats is None:
+        stats = default.service_pool_stats()
+    print "Service pool: {} hit(s), {} miss(es)".format(stats['hits'], stats['misses'])
@@ -0,0 +1,69 @@
+import time
+import threading
+
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import utils as ju
+
+
+class StartupProfile(object):
+    """
+    The time spent in the steps needed before the commands can run
+
+    The steps are the imports, the parsing of the yaml files, the discovery
+    documents, the credentials and the construction of the services.
+    """
+    def __init__(self, started=None):
+        self.lock = threading.Lock()
+        self.started = started or time.time()
+        # step -> [seconds, calls]
+        self.steps = OrderedDict()
+        self.first_request = None
+
+    def add(self, name, seconds, calls=1):
+        with self.lock:
+            step = self.steps.setdefault(name, [0., 0])
+            step[0] += seconds
+            step[1] += calls
+
+    @contextmanager
+    def step(self, name):
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, time.time() - started)
+
+    def clear(self):
+        with self.lock:
+            self.steps = OrderedDict()
+
+    def request_sent(self):
+        """
+        Called before each request, the time of the first one is kept
+        """
+        if self.first_request is None:
+            self.first_request = time.time()
+
+    def rows(self):
+        with self.lock:
+            return [(name, seconds, calls) for name, (seconds, calls) in self.steps.iteritems()]
+
+    def merge(self, rows):
+        """
+        Add the steps of another process
+        """
+        for name, seconds, calls in rows:
+            self.add(name, seconds, calls)
+
+    def print_report(self):
+        print "\n{}Startup (ms){}".format(ju.bold, ju.end_color)
+        print "{:<30} {:>6} {:>10}".format("step", "calls", "total")
+        for name, seconds, calls in self.rows():
+            print "{:<30} {:>6} {:>10.1f}".format(name, calls, seconds * 1000)
+        if self.first_request is not None:
+            print "First request sent after {:.1f}ms".format((self.first_request - self.started) * 1000)
+
+
+profile = StartupProfile()
@@ -0,0 +1,109 @@
+import re
+import json
+
+from app import files
+
+expression_matcher = re.compile("{{([^{}]*)}}")
+
+
+def _compile(value):
+    """
+    Find the `{{expression}}` leaves of a json value
+
+    Returns None when the value has no expression, ('expr', expression) for
+    an expression, or ('dict' | 'list', {key: node}) holding only the
+    children having expressions. As in the original body parsing, lists
+    nested right into lists are not looked into.
+    """
+    if isinstance(value, basestring):
+        match = expression_matcher.match(value)
+        return ('expr', match.group(1)) if match else None
+
+    if isinstance(value, dict):
+        children = {}
+        for key, val in value.iteritems():
+            node = _compile(val)
+            if node:
+                children[key] = node
+        return ('dict', children) if children else None
+
+    if isinstance(value, list):
+        children = {}
+        for idx, val in enumerate(value):
+            if isinstance(val, list):
+                continue
+            node = _compile(val)
+            if node:
+                children[idx] = node
+        return ('list', children) if children else None
+
+    return None
+
+
+def _deepcopy(value):
+    if isinstance(value, dict):
+        return dict((key, _deepcopy(val)) for key, val in value.iteritems())
+    if isinstance(value, list):
+        return [_deepcopy(val) for val in value]
+    return value
+
+
+def _render(value, node, resolve, copy):
+    if node is None:
+        return _deepcopy(value) if copy else value
+
+    kind, children = node
+    if kind == 'expr':
+        return resolve(children)
+
+    if kind == 'dict':
+        if copy:
+            rendered = dict((key, _deepcopy(val)) for key, val in value.iteritems() if key not in children)
+        else:
+            rendered = dict(value)
+        for key, child in children.iteritems():
+            rendered[key] = _render(value[key], child, resolve, copy)
+        return rendered
+
+    rendered = _deepcopy(value) if copy else list(value)
+    for idx, child in children.iteritems():
+        rendered[idx] = _render(value[idx], child, resolve, copy)
+    return rendered
+
+
+class Template(object):
+    """
+    A json value whose `{{expression}}` leaves are resolved each time it is rendered
+
+    The value is looked into once. When rendering, only the expressions are
+    evaluated and, unless a copy is requested, the parts without expressions
+    are shared with the original value.
+    """
+    def __init__(self, value):
+        self.value = value
+        self.node = _compile(value)
+
+    @property
+    def static(self):
+        return self.node is None
+
+    def render(self, resolve, copy=False):
+        """
+        Return the value with each expression replaced by `resolve(expression)`
+
+        With `copy`, the returned value shares nothing with the template, so
+        it can be modified.
+        """
+        return _render(self.value, self.node, resolve, copy)
+
+
+def _load_template(path):
+    with open(path, 'r') as f:
+        return Template(json.load(f))
+
+
+def load_template(path):
+    """
+    Return the template of a json file, a file is loaded once as long as it does not change
+    """
+    return files.load(path, _load_template)
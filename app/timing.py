@@ -0,0 +1,97 @@
+import csv
+import json
+import threading
+
+import utils as ju
+
+# the phases of a command
+PHASES = ('expressions', 'http', 'retries', 'eval_expr', 'check_result', 'check_order')
+
+settings = {
+    'summary': False,
+}
+
+
+def configure(summary=None):
+    """
+    Change the timing settings, with `summary` a table is printed at the end of each scenario
+    """
+    if summary is not None:
+        settings['summary'] = summary
+
+
+class Timings(object):
+    """
+    The time spent in each phase of the commands, by scenario, command position and endpoint key
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (scenario, position, key) -> phase -> [seconds, calls]
+        self.records = {}
+
+    def add(self, scenario, position, key, phase, seconds, calls=1):
+        with self.lock:
+            record = self.records.setdefault((scenario, position, key), {}).setdefault(phase, [0., 0])
+            record[0] += seconds
+            record[1] += calls
+
+    def clear(self):
+        with self.lock:
+            self.records = {}
+
+    def rows(self):
+        """
+        The records as a list of dicts, one per command and phase
+        """
+        with self.lock:
+            return [{'scenario': scenario, 'position': position, 'key': key, 'phase': phase,
+                     'seconds': seconds, 'calls': calls}
+                    for (scenario, position, key), phases in sorted(self.records.iteritems())
+                    for phase, (seconds, calls) in sorted(phases.iteritems(), key=lambda p: PHASES.index(p[0]))]
+
+    def merge(self, rows):
+        """
+        Add the rows of another process
+        """
+        for row in rows:
+            self.add(row['scenario'], row['position'], row['key'], row['phase'], row['seconds'], row['calls'])
+
+    def write(self, path):
+        """
+        Write the records as csv if the file name ends with .csv, else as json
+        """
+        rows = self.rows()
+        with open(path, 'wb') as f:
+            if path.endswith('.csv'):
+                writer = csv.DictWriter(f, ['scenario', 'position', 'key', 'phase', 'seconds', 'calls'])
+                writer.writeheader()
+                for row in rows:
+                    writer.writerow(dict((k, v.encode('utf-8') if isinstance(v, unicode) else v)
+                                         for k, v in row.iteritems()))
+            else:
+                json.dump(rows, f, indent=4, separators=(',', ': '))
+
+    def print_summary(self, scenario=None):
+        """
+        Print the time spent in each phase by endpoint key, for a scenario or all of them
+        """
+        totals = {}
+        with self.lock:
+            for (record_scenario, _, key), phases in self.records.iteritems():
+                if scenario is not None and record_scenario != scenario:
+                    continue
+                for phase, (seconds, _) in phases.iteritems():
+                    totals.setdefault(key, dict.fromkeys(PHASES, 0.))[phase] += seconds
+
+        if not totals:
+            return
+
+        print "\n{}Time spent by endpoint (ms){}".format(ju.bold, ju.end_color)
+        print "{:<40}".format("endpoint") + "".join("{:>13}".format(phase) for phase in PHASES) + "{:>13}".format("total")
+        # the slowest endpoints first
+        for key, phases in sorted(totals.iteritems(), key=lambda t: -sum(t[1].itervalues())):
+            print "{:<40}".format(key) + "".join("{:>13.0f}".format(phases[phase] * 1000) for phase in PHASES) + \
+                "{:>13.0f}".format(sum(phases.itervalues()) * 1000)
+
+
+timings = Timings()
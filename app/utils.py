@@ -1,5 +1,7 @@
 from __future__ import print_function
-import json, re, os
+import json, re, os, sys
+
+import report
 
 class fmt:
     """
@@ -32,14 +34,26 @@ except:
     # sorry, that works only on Linux and Mac, no windows
     tty_rows = tty_columns = 40
 
-def pretty_json(input, no_print = False):
+def pretty_json(input, no_print = False, limit=None):
     """
     JSON pretty printing
+
+    The json is written as it is encoded, when a `limit` is given, only its
+    `limit` first characters are printed.
     """
     if no_print:
         return json.dumps(input, indent=4, separators=(',', ': '))
 
-    print(json.dumps(input, indent=4, separators=(',', ': ')))
+    encoder = json.JSONEncoder(indent=4, separators=(',', ': '))
+    written = 0
+    for chunk in encoder.iterencode(input):
+        if limit is not None and written + len(chunk) > limit:
+            sys.stdout.write(chunk[:limit - written])
+            print("\n... truncated after {} characters".format(limit))
+            return
+        sys.stdout.write(chunk)
+        written += len(chunk)
+    print()
 
 def get_test_file(test_name, test_file):
     """
@@ -59,20 +73,170 @@ def light_assert(exp, message, exit_on_error=False):
         assert exp, message
         return True
     except AssertionError, e:
+        report.reporter.assertion(None, False, e.message, fatal=exit_on_error)
         if exit_on_error:
-            print(error_color)
-            print("*"*tty_columns)
-            print("* FAIL : ", e.message)
-            print("*"*tty_columns)
-            print(fmt.END)
             raise AssertionError(e.message)
-        else:
-            print(warning_color)
-            print("*" * tty_columns)
-            print("* WARNING : ", e.message)
-            print("*" * tty_columns)
-            print(fmt.END)
+        return False
+
+
+# the first element of an expectation list
+list_pattern = re.compile('#.*#')
+# `#=N#`, `#>=N#`, `#<=N#`, `#>N#` and `#<N#`
+cardinality_pattern = re.compile('#(=|>=|<=|>|<)([0-9]+)#')
+CARDINALITY_CHECKS = {
+    '=': (lambda count, expected: count == expected, u'{}'),
+    '>=': (lambda count, expected: count >= expected, u'at least {}'),
+    '<=': (lambda count, expected: count <= expected, u'{} maximum'),
+    '>': (lambda count, expected: count > expected, u'more than {}'),
+    '<': (lambda count, expected: count < expected, u'less than {}'),
+}
+
+_regexes = {}
+
+
+def compile_regex(pattern):
+    """
+    Compile a `#r#` expectation, each pattern is compiled once
+    """
+    if pattern not in _regexes:
+        _regexes[pattern] = re.compile(pattern)
+    return _regexes[pattern]
+
+
+_missing = object()
+
+
+def _as_dict(value):
+    """
+    Strings are checked as {'': value} by check_json
+    """
+    if isinstance(value, basestring):
+        return {'': value}
+    return value
+
+
+def exact_keys(expectation):
+    """
+    The keys of an expectation whose value has to be exactly equal in the result
+    """
+    expectation = _as_dict(expectation)
+    if not isinstance(expectation, dict):
+        return ()
+
+    return tuple(sorted(key for key, val in expectation.iteritems()
+                        if not isinstance(val, (dict, list)) and val != 'nil' and
+                        not (isinstance(val, basestring) and val.startswith('#r#'))))
+
+
+def regex_keys(expectation):
+    """
+    The keys of an expectation whose value is a regular expression, with the compiled expression
+    """
+    expectation = _as_dict(expectation)
+    if not isinstance(expectation, dict):
+        return ()
+
+    return tuple((key, compile_regex(val.split('#r#')[-1])) for key, val in expectation.iteritems()
+                 if isinstance(val, basestring) and val.startswith('#r#'))
+
+
+def fingerprint(value, keys):
+    """
+    The values of the given keys, compared the way check_json does
+    """
+    value = _as_dict(value)
+    if not isinstance(value, dict):
+        return None
+    return tuple(unicode(value[key]) if key in value else _missing for key in keys)
+
+
+def _matches_regex(value, regexes):
+    value = _as_dict(value)
+    for key, reg in regexes:
+        if not isinstance(value, dict) or key not in value or not reg.match(unicode(value[key])):
             return False
+    return True
+
+
+def _indexable(values):
+    """
+    Only dicts and strings can be indexed, anything else is left to check_json
+    """
+    return all(isinstance(v, (dict, basestring)) for v in values)
+
+
+class EntryIndex(object):
+    """
+    Index the entries of a result list by the values of the exact keys of the expectations
+
+    The entries are bucketed by the fingerprint of these keys, so that an
+    expectation is only compared to the entries having the same exact values
+    and matching its regular expressions.
+    """
+    def __init__(self, entries):
+        self.entries = entries
+        self.enabled = _indexable(entries)
+        self.buckets = {}
+
+    def candidates(self, expectation, remaining):
+        """
+        The remaining entry indexes which may match the expectation, in order
+        """
+        keys = exact_keys(expectation) if self.enabled else ()
+        if keys:
+            if keys not in self.buckets:
+                buckets = self.buckets[keys] = {}
+                for idx, entry in enumerate(self.entries):
+                    buckets.setdefault(fingerprint(entry, keys), []).append(idx)
+            candidates = [idx for idx in self.buckets[keys].get(fingerprint(expectation, keys), [])
+                          if idx in remaining]
+        else:
+            candidates = sorted(remaining)
+
+        if not self.enabled or not isinstance(_as_dict(expectation), dict):
+            return candidates
+
+        regexes = regex_keys(expectation)
+        return [idx for idx in candidates if _matches_regex(self.entries[idx], regexes)]
+
+
+class ExpectationIndex(object):
+    """
+    Index a list of expectations by the values of their exact keys
+
+    A result entry is only compared to the expectations having the same exact
+    values and whose regular expressions it matches.
+    """
+    def __init__(self, expectations):
+        self.expectations = expectations
+        self.enabled = _indexable(expectations)
+        # exact keys -> fingerprint -> expectation indexes
+        self.buckets = {}
+        self.unindexed = []
+        self.regexes = {}
+        if not self.enabled:
+            return
+
+        for idx, expectation in enumerate(expectations):
+            keys = exact_keys(expectation)
+            if keys:
+                self.buckets.setdefault(keys, {}).setdefault(fingerprint(expectation, keys), []).append(idx)
+            else:
+                self.unindexed.append(idx)
+            self.regexes[idx] = regex_keys(expectation)
+
+    def candidates(self, entry, remaining):
+        """
+        The remaining expectation indexes which may match the entry, in order
+        """
+        if not self.enabled or not isinstance(_as_dict(entry), (dict, basestring)):
+            return sorted(remaining)
+
+        candidates = [idx for idx in self.unindexed if idx in remaining]
+        for keys, buckets in self.buckets.iteritems():
+            candidates.extend(idx for idx in buckets.get(fingerprint(entry, keys), []) if idx in remaining)
+
+        return [idx for idx in sorted(candidates) if _matches_regex(entry, self.regexes[idx])]
 
 
 def check_json(result, expectation, path="$", exit_on_error=False, skip_errors=False):
@@ -118,7 +282,7 @@ def check_json(result, expectation, path="$", exit_on_error=False, skip_errors=F
             pattern = ""
             if len(exp) > 0 :
                 no_error = light_assert(
-                    re.match('#.*#', unicode(exp[0])),
+                    list_pattern.match(unicode(exp[0])),
                     u"The first element in the expectation list has to be a pattern enclosed in #, you gave {}".format(exp[0]),
                     exit_on_error=exit_on_error)
                 pattern = unicode(exp[0])
@@ -132,35 +296,13 @@ def check_json(result, expectation, path="$", exit_on_error=False, skip_errors=F
                     u'The number of results in path "{}" is not empty as expected (there were {} entries)'.format(path, len(exp)),
                     exit_on_error=exit_on_error)
 
-            # Check that we have the same number of entries
-            elif len(exp) == 1 and re.match('#=[0-9]+#', pattern):
+            # Check the number of entries
+            elif len(exp) == 1 and cardinality_pattern.match(pattern):
+                operator, count = cardinality_pattern.match(pattern).groups()
+                compare, message = CARDINALITY_CHECKS[operator]
                 no_error = light_assert(
-                    len(res) == int(re.findall('#=([0-9]+)#', exp[0])[0]),
-                    u'The number of results in path "{}" does not match what expected (there were {} entries rather than {})'.format(path, len(res), int(re.findall('#=([0-9]+)', exp[0])[0])),
-                    exit_on_error=exit_on_error)
-
-            elif len(exp) == 1 and re.match('#>=[0-9]+#', pattern):
-                no_error = light_assert(
-                    len(res) >= int(re.findall('#>=([0-9]+)#', exp[0])[0]),
-                    u'The number of results in path "{}" does not match what expected (there were {} entries rather than at least {})'.format(path, len(res), int(re.findall('#>=([0-9]+)', exp[0])[0])),
-                    exit_on_error=exit_on_error)
-
-            elif len(exp) == 1 and re.match('#<=[0-9]+#', pattern):
-                no_error = light_assert(
-                    len(res) <= int(re.findall('#<=([0-9]+)#', exp[0])[0]),
-                    u'The number of results in path "{}" does not match what expected (there were {} entries rather than {} maximum)'.format(path, len(res), int(re.findall('#<=([0-9]+)', exp[0])[0])),
-                    exit_on_error=exit_on_error)
-
-            elif len(exp) == 1 and re.match('#>[0-9]+#', pattern):
-                no_error = light_assert(
-                    len(res) > int(re.findall('#>([0-9]+)#', exp[0])[0]),
-                    u'The number of results in path "{}" does not match what expected (there were {} entries rather than more than {})'.format(path, len(res), int(re.findall('#>([0-9]+)', exp[0])[0])),
-                    exit_on_error=exit_on_error)
-
-            elif len(exp) == 1 and re.match('#<[0-9]+#', pattern):
-                no_error = light_assert(
-                    len(res) < int(re.findall('#<([0-9]+)#', exp[0])[0]),
-                    u'The number of results in path "{}" does not match what expected (there were {} entries rather than less than {})'.format(path, len(res), int(re.findall('#<([0-9]+)', exp[0])[0])),
+                    compare(len(res), int(count)),
+                    u'The number of results in path "{}" does not match what expected (there were {} entries rather than {})'.format(path, len(res), message.format(int(count))),
                     exit_on_error=exit_on_error)
 
             # Check that we have at least one entry
@@ -192,11 +334,13 @@ def check_json(result, expectation, path="$", exit_on_error=False, skip_errors=F
                     exit_on_error=exit_on_error)
 
                 iterations = 0
-                entries = range(len(res))
+                entries = set(range(len(res)))
+                index = EntryIndex(res)
                 exp_cpy = exp[:]
                 while iterations < len(res):
                     exp_val = exp_cpy.pop()
-                    for idx in entries:
+                    # only the results having the same exact values as the expectation can match it
+                    for idx in index.candidates(exp_val, entries):
                         no_err = check_json(res[idx], exp_val, path + "[{}]".format(idx + 1), exit_on_error=exit_on_error,
                                 skip_errors=True)
                         if no_err:
@@ -225,15 +369,18 @@ def check_json(result, expectation, path="$", exit_on_error=False, skip_errors=F
             # It's a mix of PATTERN and ALL.
             # Number of items must match number of expected results, and expected results must respect pattern.
             elif len(exp) > 0 and pattern == "#MATCH#":
-                light_assert(
+                same_length = light_assert(
                     len(res) == len(exp),
                     u'The number of results in path "{}" does not match what expected (there were {} entries rather than {})'.format(path, len(res), len(exp)),
                     exit_on_error=exit_on_error)
 
                 iterations = 0
-                entries = range(len(res))
+                # the expectations not matched yet
+                entries = set(range(len(exp)))
+                index = ExpectationIndex(exp)
                 while iterations < len(res):
-                    for idx in entries:
+                    # only the expectations having the same exact values as the result can match it
+                    for idx in index.candidates(res[iterations], entries):
                         no_err = check_json(res[iterations], exp[idx], path + "[{}]".format(idx + 1), exit_on_error=False,
                                             skip_errors=True)
                         if no_err:
@@ -244,7 +391,7 @@ def check_json(result, expectation, path="$", exit_on_error=False, skip_errors=F
                 no_error = light_assert(
                     iterations == len(res) and len(entries) == 0,
                     'The results in path "{}" do not match what expected'.format(path),
-                    exit_on_error=exit_on_error)
+                    exit_on_error=exit_on_error) and same_length
 
             # It's a mix of MATCH and ANY.
             # Check at least one item is respecting pattern. No check on number of items matching.
@@ -299,7 +446,7 @@ def check_json(result, expectation, path="$", exit_on_error=False, skip_errors=F
             # if we are requesting a regexp
             if exp.startswith("#r#"):
                 exp = exp.split('#r#')[-1]
-                reg = re.compile(exp)
+                reg = compile_regex(exp)
                 no_error = light_assert(
                     reg.match(res),
                     (u'The result "{}" does not match the regex "{}"'
@@ -317,10 +464,7 @@ def check_json(result, expectation, path="$", exit_on_error=False, skip_errors=F
                 no_error = False
 
         if not skip_errors:
-            if no_error:
-                print(info_color, path, success_color, bold, "DONE", end_color)
-            else:
-                print(info_color, path, error_color, bold, "FAILURE", end_color)
+            report.reporter.assertion(path, no_error)
         elif no_error is False:
             # break loop only if a test fail, else continue to check other items of `expectation`.
             return False
@@ -366,10 +510,7 @@ def check_order_values(results, directions, paths=None, exit_on_error=False, ski
 
 
         if not skip_errors:
-            if no_error:
-                print(info_color, path, success_color, bold, "DONE", end_color)
-            else:
-                print(info_color, path, error_color, bold, "FAILURE", end_color)
+            report.reporter.assertion(path, no_error)
         # else:
     return no_error
 
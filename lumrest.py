@@ -1,19 +1,76 @@
 #!/usr/bin/env python2.7
+import time
+started = time.time()
+
 import sys
 import os
 import argparse
-import yaml
-from app.expression import expr_constructor, json_constructor
 from app import default
+from app import cassette
+from app import mock
+from app import runner
+from app import discovery
+from app import files
+from app import timing
+from app import latency
+from app import report
+from app import startup
+
+startup.profile.started = started
+startup.profile.add('import lumrest', time.time() - started)
 
 
 def main():
     parser = argparse.ArgumentParser(description='Endpoint tester')
     parser.add_argument("--auth", metavar='AUTH_CONFIG_FILE', type=str,
                         help='The configuration file containg authentication information')
-    parser.add_argument("scenario_file", metavar='SCENARIO_FILE', type=str, nargs="?",
-                        help='The path to the scenario file')
+    parser.add_argument("scenario_files", metavar='SCENARIO_FILE', type=str, nargs="*",
+                        help='The path to the scenario file, several files, directories or glob patterns can be given')
     parser.add_argument("-X", action="store_true", default=False, help='Stop at the first error')
+    parser.add_argument("-j", "--jobs", metavar='N', type=int, default=1,
+                        help='Number of scenarios to run in parallel when several are given')
+    parser.add_argument("--discovery-cache", metavar='DIR', type=str, default=None,
+                        help='The folder where the API discovery documents are cached')
+    parser.add_argument("--discovery-ttl", metavar='SECONDS', type=int, default=None,
+                        help='How long the cached discovery documents are used (0 for ever)')
+    parser.add_argument("--scenario-cache", metavar='DIR', type=str, default=None,
+                        help='The folder where the parsed scenarios are cached')
+    parser.add_argument("--no-scenario-cache", action="store_true", default=False,
+                        help='Parse the scenarios without the on-disk cache')
+    parser.add_argument("--offline", action="store_true", default=False,
+                        help='Only use cached discovery documents')
+    parser.add_argument("--record", metavar='DIR', type=str, default=None,
+                        help='Record the requests and their responses in a folder')
+    parser.add_argument("--replay", metavar='DIR', type=str, default=None,
+                        help='Answer the requests with the responses recorded in a folder, without network access')
+    parser.add_argument("--mock", metavar='MOCK_CONFIG_FILE', type=str, default=None,
+                        help='Answer the requests with a mock backend driven by the discovery documents')
+    parser.add_argument("--mock-server", metavar='[HOST:]PORT', type=str, default=None,
+                        help='Serve the mock backend over HTTP rather than running scenarios')
+    parser.add_argument("--check", action="store_true", default=False,
+                        help='Check the scenarios and their includes without running them')
+    parser.add_argument("--load", action="store_true", default=False,
+                        help='Run the scenario as a load test and report the latency of each endpoint')
+    parser.add_argument("--users", metavar='N', type=int, default=1,
+                        help='Number of virtual users running the scenario in load mode')
+    parser.add_argument("--duration", metavar='SECONDS', type=float, default=None,
+                        help='How long the virtual users run the scenario in load mode')
+    parser.add_argument("--iterations", metavar='N', type=int, default=None,
+                        help='How many times each virtual user runs the scenario in load mode')
+    parser.add_argument("--ramp-up", metavar='SECONDS', type=float, default=0,
+                        help='The time over which the virtual users are started in load mode')
+    parser.add_argument("--timings", action="store_true", default=False,
+                        help='Print the time spent in each phase of the commands at the end of each scenario')
+    parser.add_argument("--timing-report", metavar='FILE', type=str, default=None,
+                        help='Write the time spent in each phase of the commands to a json or csv file')
+    parser.add_argument("--update-baseline", action="store_true", default=False,
+                        help='Replace the latency baselines by the latencies of this run')
+    parser.add_argument("--junit", metavar='FILE', type=str, default=None,
+                        help='Write the results of the commands as a JUnit XML report')
+    parser.add_argument("--json-report", metavar='FILE', type=str, default=None,
+                        help='Write the events of the run (commands, checks, timings) as json lines')
+    parser.add_argument("--profile-startup", action="store_true", default=False,
+                        help='Print the time spent in the steps needed before the commands can run')
     parser.add_argument("--version", action="store_true", default=False, help='Get version number')
     args = parser.parse_args()
 
@@ -21,24 +78,48 @@ def main():
         print default.__version__
         return 0
 
-    if args.scenario_file:
-        scenario_root = os.path.abspath(os.path.join(os.path.abspath(args.scenario_file), os.pardir))
-        scenario_file_path = os.path.abspath(args.scenario_file)
+    discovery.configure(cache_dir=args.discovery_cache, ttl=args.discovery_ttl, offline=args.offline)
+    files.configure(cache_dir=False if args.no_scenario_cache else args.scenario_cache)
+    timing.configure(summary=args.timings)
+    latency.configure(update_baseline=args.update_baseline)
+    try:
+        cassette.configure(record=args.record, replay=args.replay)
+        mock.configure(config=args.mock)
+    except ValueError as e:
+        print e
+        return -1
 
-        # check that there is a scenario file
-        if not os.path.isfile(scenario_file_path):
-            print "{} does not exist".format(scenario_file_path)
+    if args.mock_server:
+        try:
+            mock.serve(args.mock_server)
+        except ValueError as e:
+            print e
             return -1
+        return 0
 
-        with open(scenario_file_path, 'r') as scene_file:
-            yaml.add_constructor('!expr', expr_constructor)
-            yaml.add_constructor('!json', json_constructor)
-            scene = yaml.load(scene_file)
+    if args.scenario_files:
+        try:
+            scenario_files = runner.find_scenarios(args.scenario_files)
+        except ValueError as e:
+            print e
+            return -1
+
+        if args.check:
+            from app import check
+            return check.check_scenarios(scenario_files, jobs=args.jobs)
+
+        if len(args.scenario_files) == 1 and os.path.isfile(args.scenario_files[0]):
+            scenario_file = scenario_files[0]
+            scene, scenario_root = runner.load_scenario(scenario_file)
+            scenario_files = None
+    elif args.check:
+        print "The check mode needs scenario files"
+        return -1
     else:
+        scenario_files = None
+        scenario_file = None
         scenario_root = os.path.abspath(os.path.join(os.path.abspath("."), os.pardir))
-        yaml.add_constructor('!expr', expr_constructor)
-        yaml.add_constructor('!json', json_constructor)
-        scene = yaml.load(sys.stdin.read())
+        scene = files.parse_yaml(sys.stdin.read())
 
     if args.auth:
         # check that there is a config file
@@ -46,13 +127,50 @@ def main():
             print "{} does not exist".format(args.auth)
             return -1
 
+        import yaml
         with open(args.auth, 'r') as conf:
             config = yaml.load(conf)
     else:
         config = {}
 
-    command_parser = default.CommandParser(config, scene, scenario_root, exit_on_error=args.X)
-    return command_parser.parse()
+    if args.load and (args.junit or args.json_report):
+        print "The reports are not written in load mode"
+        return -1
+    report.configure(junit=args.junit, json_lines=args.json_report)
+
+    if args.load:
+        if scenario_files:
+            print "The load mode runs a single scenario"
+            return -1
+        from app import load
+        try:
+            error = load.run_load(scene, scenario_root, config, users=args.users, duration=args.duration,
+                                  iterations=args.iterations, ramp_up=args.ramp_up, scenario_file=scenario_file)
+        except ValueError as e:
+            print e
+            return -1
+    elif scenario_files:
+        error = runner.run_scenarios(scenario_files, config, exit_on_error=args.X, jobs=args.jobs)
+    else:
+        command_parser = default.CommandParser(config, scene, scenario_root, exit_on_error=args.X,
+                                               scenario_file=scenario_file)
+        error = command_parser.parse()
+        runner.print_service_pool_stats()
+
+    report.reporter.close()
+    if args.junit:
+        print "JUnit report written to {}".format(args.junit)
+    if args.json_report:
+        print "Events written to {}".format(args.json_report)
+
+    if args.timing_report:
+        timing.timings.write(args.timing_report)
+        print "Timings written to {}".format(args.timing_report)
+
+    if args.profile_startup:
+        startup.profile.print_report()
+
+    return error
 
 if __name__ == "__main__":
     sys.exit(main())
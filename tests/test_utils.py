@@ -0,0 +1,26 @@
+import unittest
+
+from app import utils
+
+
+class CheckJsonTest(unittest.TestCase):
+
+    def test_match_more_results_than_expectations(self):
+        # the entries which are not dicts are compared to every expectation left
+        result = {'items': [{'id': 1}, None, None]}
+        expectation = {'items': ['#MATCH#', {'id': 1}]}
+        self.assertFalse(utils.check_json(result, expectation, skip_errors=True))
+
+    def test_match_more_expectations_than_results(self):
+        result = {'items': [{'id': 1}]}
+        expectation = {'items': ['#MATCH#', {'id': 1}, {'id': 2}]}
+        self.assertFalse(utils.check_json(result, expectation, skip_errors=True))
+
+    def test_match_any_order(self):
+        result = {'items': [{'id': 2}, {'id': 1}]}
+        expectation = {'items': ['#MATCH#', {'id': 1}, {'id': 2}]}
+        self.assertTrue(utils.check_json(result, expectation, skip_errors=True))
+
+
+if __name__ == '__main__':
+    unittest.main()